@@ -11,6 +11,8 @@ from asyncio import iscoroutine
 
 # Load bot core
 from core import config, console, database, locales, cfg_factory
+from core.scheduler import scheduler
+from core.workers import workers
 from core.client import dc
 
 loop = asyncio.get_event_loop()
@@ -19,6 +21,10 @@ loop.run_until_complete(database.db.connect())
 # Load bot
 import bot
 
+# Create or update all database tables declared by the bot modules
+loop.run_until_complete(database.db.ensure_tables())
+loop.run_until_complete(cfg_factory.ensure_versions())
+
 # Load web server
 if config.cfg.WS_ENABLE:
 	from webui import webserver
@@ -63,6 +69,9 @@ async def think():
 	for task in dc.events['on_init']:
 		await task()
 
+	# Bot background jobs are run by the scheduler at their deadlines
+	scheduler_task = asyncio.create_task(scheduler.run())
+
 	# Loop runs roughly every 1 second
 	while console.alive:
 		frame_time = time.time()
@@ -75,6 +84,7 @@ async def think():
 		await asleep(1)
 
 	# Exit signal received
+	scheduler_task.cancel()
 	for task in dc.events['on_exit']:
 		try:
 			await task()
@@ -84,6 +94,9 @@ async def think():
 	log.info("Waiting for connection to close...")
 	await dc.close()
 
+	log.info("Stopping worker processes.")
+	workers.shutdown()
+
 	log.info("Closing db.")
 	await database.db.close()
 	if webserver:
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Matchmaking team balancer latency and balance quality from 2v2 to 50v50 against the old exhaustive
+combinations() search, which is only run for small queues. Quality is the rating sum difference of the teams.
+python -m benchmarks.balance [trials]
+"""
+import sys
+import random
+from itertools import combinations
+from time import perf_counter
+
+from benchmarks.common import ms, print_table
+from bot.match.balance import balance_teams
+
+TEAM_SIZES = (2, 3, 4, 5, 6, 8, 10, 12, 15, 20, 30, 40, 50)
+OLD_LIMIT = 8  # max team size to run the old search for, 9v9 already takes seconds
+
+
+def old_balance(values, team_len):
+	""" Match.init_teams('matchmaking') before the balancer """
+	best_rating = sum(values)/2
+	return min(combinations(range(len(values)), team_len), key=lambda team: abs(sum([values[i] for i in team])-best_rating))
+
+
+def difference(values, team):
+	team_sum = sum(values[i] for i in team)
+	return abs(sum(values) - team_sum * 2)
+
+
+def main(trials):
+	rows = []
+	for team_size in TEAM_SIZES:
+		new_times, new_diffs, old_times, old_diffs = [], [], [], []
+		for _ in range(trials):
+			values = [random.randint(800, 2400) for _ in range(team_size * 2)]
+
+			started = perf_counter()
+			team = balance_teams(values, team_size)
+			new_times.append(perf_counter() - started)
+			new_diffs.append(difference(values, team))
+
+			if team_size <= OLD_LIMIT:
+				started = perf_counter()
+				team = old_balance(values, team_size)
+				old_times.append(perf_counter() - started)
+				old_diffs.append(difference(values, team))
+
+		rows.append([
+			f"{team_size}v{team_size}",
+			ms(sum(new_times) / len(new_times)), ms(max(new_times)), f"{sum(new_diffs) / len(new_diffs):.1f}", max(new_diffs),
+			ms(sum(old_times) / len(old_times)) if old_times else "-",
+			f"{sum(old_diffs) / len(old_diffs):.1f}" if old_diffs else "-"
+		])
+
+	print(f"Team balancing of random 800-2400 ratings, {trials} trials per size:")
+	print_table(["teams", "avg ms", "max ms", "avg diff", "max diff", "old avg ms", "old avg diff"], rows)
+
+
+if __name__ == '__main__':
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
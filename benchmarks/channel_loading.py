@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Time-to-ready and memory of queue channels registered as stubs at startup against loading every channel eagerly,
+and the cost of loading one channel on its first use. Channels are synthetic, no discord connection or database
+is needed: config rows are generated with roles set on all the role variables and three queues per channel.
+python -m benchmarks.channel_loading [channels]
+"""
+import sys
+import json
+import gc
+import tracemalloc
+from time import perf_counter
+from types import SimpleNamespace
+
+from benchmarks.common import ms, print_table, run
+from core.cfg_factory import RoleVar
+import bot
+
+QUEUES = 3
+
+
+class Guild(SimpleNamespace):
+	""" Guild with every requested role, channel and member """
+
+	def get_role(self, role_id):
+		return SimpleNamespace(id=role_id, name=f"role{role_id}", mention=f"<@&{role_id}>")
+
+	def get_channel(self, channel_id):
+		return SimpleNamespace(id=channel_id, name=f"channel{channel_id}", guild=self)
+
+	def get_member(self, user_id):
+		return SimpleNamespace(id=user_id, name=f"member{user_id}")
+
+
+def config_row(factory, p_key, info, **keys):
+	roles = {name: 1000 + i for i, (name, var) in enumerate(factory.variables.items()) if isinstance(var, RoleVar)}
+	return dict(
+		**keys, factory_version=1, cfg_name=factory.name, cfg_info=json.dumps(info),
+		cfg_data=json.dumps(dict(factory.blank, **roles), default=str), **{factory.table.p_key: p_key}
+	)
+
+
+def make_rows(channels):
+	rows = []
+	for channel_id in range(1, channels+1):
+		guild = Guild(id=channel_id, name=f"guild{channel_id}")
+		channel = guild.get_channel(channel_id)
+		info = dict(channel_name=channel.name, guild_id=guild.id, guild_name=guild.name)
+		qc_row = config_row(bot.QueueChannel.cfg_factory, channel_id, info)
+		pq_rows = [
+			config_row(bot.PickupQueue.cfg_factory, channel_id * QUEUES + i, dict(), channel_id=channel_id)
+			for i in range(QUEUES)
+		]
+		rows.append((channel, qc_row, pq_rows))
+	return rows
+
+
+def register_stubs(rows):
+	""" What on_ready does for every channel now """
+	return {channel.id: dict(guild_id=channel.guild.id, qc_row=qc_row, pq_rows=pq_rows) for channel, qc_row, pq_rows in rows}
+
+
+async def load_all(rows):
+	""" What on_ready did for every channel before the channels were loaded lazily """
+	channels = dict()
+	for channel, qc_row, pq_rows in rows:
+		channels[channel.id] = qc = await bot.QueueChannel.load(channel, dict(qc_row), [dict(row) for row in pq_rows])
+		await qc.update_info(channel)
+	return channels
+
+
+async def measure_memory(coro_func, *args):
+	""" Return (result, seconds, bytes allocated and kept by the result) """
+	gc.collect()
+	tracemalloc.start()
+	started = perf_counter()
+	result = await coro_func(*args)
+	took = perf_counter() - started
+	gc.collect()
+	size = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return result, took, size
+
+
+async def main(channels):
+	async def fetch(channels):
+		return make_rows(channels)
+
+	rows, _, rows_size = await measure_memory(fetch, channels)
+
+	async def lazy(rows):
+		return register_stubs(rows)
+
+	# Timings are taken separately as tracemalloc slows the allocations down
+	started = perf_counter()
+	register_stubs(rows)
+	lazy_time = perf_counter() - started
+	started = perf_counter()
+	await load_all(rows)
+	eager_time = perf_counter() - started
+	_, _, lazy_size = await measure_memory(lazy, rows)
+	_, _, eager_size = await measure_memory(load_all, rows)
+
+	started = perf_counter()
+	for row in rows[:100]:
+		await load_all([row])
+	first_use = (perf_counter() - started) / min(100, len(rows))
+
+	print(f"{channels} queue channels with {QUEUES} queues each, config rows already fetched:")
+	print_table(["startup", "time to ready ms", "memory MiB"], [
+		["stubs, lazy", ms(lazy_time), f"{lazy_size / 2**20:.1f}"],
+		["eager", ms(eager_time), f"{eager_size / 2**20:.1f}"]
+	])
+	print(f"Fetched config rows take {rows_size / 2**20:.1f} MiB, the stubs keep them until the channel is loaded.")
+	print(f"Loading a channel on its first use: {ms(first_use)} ms")
+
+
+if __name__ == '__main__':
+	run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000))
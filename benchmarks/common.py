@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers of the benchmark scripts. Run the scripts from the bot directory, e.g. python -m benchmarks.balance
+Database benchmarks use the database of config.cfg, their rows are written under SCRATCH_ID channel and guild ids
+and deleted afterwards, so do not point them at a database you can not afford to slow down for a while.
+"""
+import asyncio
+from time import perf_counter
+from prettytable import PrettyTable
+
+SCRATCH_ID = 1  # channel and guild id of the seeded rows, discord snowflakes are never this small
+
+
+def measure(func, *args, repeat=5, number=1):
+	""" Return the best time of repeat runs of number func(*args) calls, in seconds per call """
+	best = None
+	for _ in range(repeat):
+		started = perf_counter()
+		for _ in range(number):
+			func(*args)
+		took = (perf_counter() - started) / number
+		best = took if best is None else min(best, took)
+	return best
+
+
+async def ameasure(coro_func, *args, repeat=5, number=1, setup=None):
+	""" Coroutine version of measure(), setup() is called before every run and is not timed """
+	best = None
+	for _ in range(repeat):
+		if setup:
+			setup()
+		started = perf_counter()
+		for _ in range(number):
+			await coro_func(*args)
+		took = (perf_counter() - started) / number
+		best = took if best is None else min(best, took)
+	return best
+
+
+def ms(seconds):
+	return f"{seconds * 1000:.2f}"
+
+
+def us(seconds):
+	return f"{seconds * 1000000:.2f}"
+
+
+def print_table(field_names, rows):
+	table = PrettyTable()
+	table.field_names = field_names
+	table.align = "r"
+	table.add_rows(rows)
+	print(table.get_string())
+
+
+async def connect():
+	""" Connect to the database and create the bot tables """
+	from core.database import db
+	import bot  # declares the tables
+	await db.connect()
+	await db.ensure_tables()
+	return db
+
+
+async def insert_blocks(db, table, rows, block=5000):
+	for i in range(0, len(rows), block):
+		await db.insert_many(table, rows[i:i+block], on_dublicate='ignore')
+
+
+def run(coro):
+	return asyncio.get_event_loop().run_until_complete(coro)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Config.load() of 10k queue channel and 10k queue configs against the old implementation which awaited wrap()
+of every variable and decoded the json with the stdlib module. Rows are the synthetic ones of channel_loading.
+python -m benchmarks.config_loading [configs]
+"""
+import sys
+import json
+
+from benchmarks.common import ameasure, ms, print_table, run
+from benchmarks.channel_loading import Guild, config_row
+from core import cfg_factory
+from core.cfg_factory import Config
+from core.console import log
+import bot
+
+
+async def old_load(factory, row, guild):
+	""" Config.load() before the precompiled loaders """
+	self = Config.__new__(Config)
+	self._guild_id = guild.id
+	self._factory = factory
+	self.cfg_info = json.loads(row.pop("cfg_info"))
+	self.p_key = row.pop(factory.table.p_key)
+
+	cfg_data = json.loads(row['cfg_data'])
+	for var in self._factory.variables.values():
+		try:
+			obj = await var.wrap(cfg_data.get(var.name, var.default), guild)
+		except Exception as e:
+			log.error("Failed to wrap variable '{}': {}".format(var.name, str(e)))
+			obj = await var.wrap(var.default, guild)
+		setattr(self, var.name, obj)
+	return self
+
+
+async def main(configs):
+	guild = Guild(id=1, name="guild")
+	rows = []
+	for factory in (bot.QueueChannel.cfg_factory, bot.PickupQueue.cfg_factory):
+		keys = {factory.table.f_key: 1} if factory.table.f_key else {}
+		factory_rows = [config_row(factory, p_key, dict(), **keys) for p_key in range(1, configs+1)]
+
+		async def load_all(load):
+			for row in factory_rows:
+				await load(factory, dict(row), guild)
+
+		old = await ameasure(load_all, old_load, repeat=3)
+		new = await ameasure(load_all, Config.load, repeat=3)
+		rows.append([factory.name, len(factory.variables), ms(old), ms(new), f"{old / new:.1f}x"])
+
+	print(f"Loading {configs} configs, best of 3 runs, json decoder: {cfg_factory.json_loads.__module__}")
+	print_table(["config", "variables", "old ms", "new ms", "speedup"], rows)
+
+
+if __name__ == '__main__':
+	run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000))
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+BaseRating.get_players() on a synthetic 50k players channel: the old whole channel select with a linear
+find() per requested player against the user_id lookup, with a cold and a warm rating cache.
+python -m benchmarks.get_players [players]
+"""
+import sys
+import random
+
+from benchmarks.common import SCRATCH_ID, ameasure, ms, print_table, connect, insert_blocks, run
+from core.utils import find
+
+
+async def old_get_players(db, rating, user_ids):
+	""" get_players() before the user_id lookup """
+	data = await db.select(
+		['user_id', 'rating', 'deviation', 'channel_id', 'wins', 'losses', 'draws', 'streak'], rating.table,
+		where={'channel_id': rating.channel_id}
+	)
+	return [find(lambda p: p['user_id'] == user_id, data) for user_id in user_ids]
+
+
+async def main(players):
+	db = await connect()
+	from bot.stats.rating import FlatRating, cache
+
+	await db.delete('qc_players', where={'channel_id': SCRATCH_ID})
+	await insert_blocks(db, 'qc_players', [dict(
+		channel_id=SCRATCH_ID, user_id=user_id, nick=f"player{user_id}", rating=random.randint(800, 2200),
+		deviation=random.randint(50, 300), wins=random.randint(0, 500), losses=random.randint(0, 500)
+	) for user_id in range(1, players+1)])
+
+	rating = FlatRating(channel_id=SCRATCH_ID)
+	rows = []
+	try:
+		for size in (2, 10, 50):
+			user_ids = random.sample(range(1, players+1), size)
+			old = await ameasure(old_get_players, db, rating, user_ids, repeat=3)
+			cold = await ameasure(rating.get_players, user_ids, setup=lambda: cache.drop(SCRATCH_ID))
+			warm = await ameasure(rating.get_players, user_ids, number=100)
+			rows.append([size, ms(old), ms(cold), ms(warm), f"{old / cold:.0f}x"])
+	finally:
+		cache.drop(SCRATCH_ID)
+		await db.delete('qc_players', where={'channel_id': SCRATCH_ID})
+
+	print(f"get_players() on a {players} players channel, best of the runs:")
+	print_table(["players requested", "old ms", "cold cache ms", "warm cache ms", "speedup (cold)"], rows)
+
+
+if __name__ == '__main__':
+	run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000))
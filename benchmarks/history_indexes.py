@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Latency of the rating history, player matches and noadds lookups on a seeded million rows history,
+with the declared secondary indexes and with them ignored by IGNORE INDEX hints.
+Rows are seeded under channel ids from SCRATCH_ID, negative match ids and SCRATCH_ID guild id and deleted afterwards.
+python -m benchmarks.history_indexes [history rows]
+"""
+import sys
+import random
+from time import perf_counter
+
+from benchmarks.common import SCRATCH_ID, ms, print_table, connect, insert_blocks, run
+
+CHANNELS = 10
+TEAM_SIZE = 5
+LOOKUPS = 20  # random keys per query
+
+QUERIES = (
+	(
+		"undo: history by match_id", "idx_match_id", 'match',
+		"SELECT `user_id`, `rating_change`, `deviation_change` FROM `qc_rating_history` {hint} WHERE `match_id`=%s"
+	),
+	(
+		"!rank: player history", "idx_channel_id_user_id", 'player',
+		"SELECT `at`, `rating_change`, `match_id` FROM `qc_rating_history` {hint} " +
+		"WHERE `channel_id`=%s AND `user_id`=%s ORDER BY `id` DESC LIMIT 10"
+	),
+	(
+		"last games of a channel", "idx_channel_id_user_id", 'channel',
+		"SELECT MAX(h.at) AS at, h.user_id FROM `qc_rating_history` AS h {hint} " +
+		"WHERE h.channel_id=%s AND h.match_id IS NOT NULL GROUP BY h.user_id"
+	),
+	(
+		"rebuild: matches of a channel", "idx_channel_id_match_id", 'channel',
+		"SELECT DISTINCT `match_id` FROM `qc_rating_history` {hint} WHERE `channel_id`=%s AND `match_id` IS NOT NULL"
+	),
+	(
+		"!stats: player matches", "idx_channel_id_user_id", 'player',
+		"SELECT COUNT(*) AS count FROM `qc_player_matches` {hint} WHERE `channel_id`=%s AND `user_id`=%s"
+	),
+	(
+		"noadds of a member", "idx_guild_id_user_id_is_active", 'member',
+		"SELECT `duration`, `at` FROM `noadds` {hint} WHERE `guild_id`=%s AND `user_id`=%s AND `is_active`=1"
+	),
+	(
+		"noadds: next expiry", "idx_is_active_expires_at", None,
+		"SELECT MIN(`expires_at`) AS release_at FROM `noadds` {hint} WHERE `is_active`=1"
+	)
+)
+
+
+async def seed(db, history_rows):
+	matches = history_rows // (TEAM_SIZE * 2)
+	players = max(100, matches // 20)
+	history, player_matches = [], []
+	for match_id in range(1, matches+1):
+		channel_id = SCRATCH_ID + match_id % CHANNELS
+		for user_id in random.sample(range(1, players+1), TEAM_SIZE * 2):
+			history.append(dict(
+				channel_id=channel_id, user_id=user_id, at=match_id * 60, rating_before=1500,
+				rating_change=random.randint(-30, 30), deviation_before=100, deviation_change=-1,
+				match_id=-match_id, reason="benchmark"
+			))
+			player_matches.append(dict(match_id=-match_id, channel_id=channel_id, user_id=user_id, nick="player", team=0))
+	await insert_blocks(db, 'qc_rating_history', history)
+	await insert_blocks(db, 'qc_player_matches', player_matches)
+	await insert_blocks(db, 'noadds', [dict(
+		guild_id=SCRATCH_ID, user_id=user_id, name="player", is_active=int(user_id % 50 == 0),
+		at=user_id, duration=3600, expires_at=user_id+3600, reason="benchmark", by="benchmark"
+	) for user_id in range(1, players * 10)])
+	return matches, players
+
+
+async def cleanup(db):
+	for channel_id in range(SCRATCH_ID, SCRATCH_ID + CHANNELS):
+		await db.delete('qc_rating_history', where={'channel_id': channel_id})
+		await db.delete('qc_player_matches', where={'channel_id': channel_id})
+	await db.delete('noadds', where={'guild_id': SCRATCH_ID})
+
+
+async def main(history_rows):
+	db = await connect()
+	await cleanup(db)
+	started = perf_counter()
+	matches, players = await seed(db, history_rows)
+	await db.execute("ANALYZE TABLE `qc_rating_history`, `qc_player_matches`, `noadds`")
+	print(f"Seeded {history_rows} history rows in {perf_counter() - started:.0f}s")
+
+	keys = dict(
+		match=lambda: (-random.randint(1, matches), ),
+		player=lambda: (SCRATCH_ID + random.randrange(CHANNELS), random.randint(1, players)),
+		channel=lambda: (SCRATCH_ID + random.randrange(CHANNELS), ),
+		member=lambda: (SCRATCH_ID, random.randint(1, players * 10)),
+	)
+	rows = []
+	try:
+		for name, index, key, sql in QUERIES:
+			args = [keys[key]() if key else () for _ in range(LOOKUPS)]
+			times = []
+			for hint in ("", f"IGNORE INDEX (`{index}`)"):
+				statement = sql.format(hint=hint)
+				await db.fetchall(statement, args[0])  # warm up the buffer pool
+				started = perf_counter()
+				for i in args:
+					await db.fetchall(statement, i)
+				times.append((perf_counter() - started) / len(args))
+			rows.append([name, index, ms(times[0]), ms(times[1]), f"{times[1] / times[0]:.0f}x"])
+	finally:
+		await cleanup(db)
+
+	print(f"Average of {LOOKUPS} lookups, {history_rows} history rows in {CHANNELS} channels:")
+	print_table(["query", "index", "indexed ms", "ignored ms", "speedup"], rows)
+
+
+if __name__ == '__main__':
+	run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000))
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Ratings snap and reset on a synthetic 100k players channel, the old full table REPLACE implementations
+against BaseRating.snap_ratings() and BaseRating.reset(). A third of the players are already on a rank rating.
+python -m benchmarks.snap_reset [players] [--cpu]
+--cpu only compares the rank floor lookups and does not need a database.
+"""
+import sys
+import time
+import random
+from bisect import bisect_right
+from time import perf_counter
+
+from benchmarks.common import SCRATCH_ID, measure, ms, print_table, connect, insert_blocks, run
+
+RANKS = [0, 1000, 1100, 1200, 1300, 1400, 1500, 1600, 1700, 1800, 1900, 2000, 2100, 2200, 2400]
+
+
+def players_rows(players):
+	rank_ratings = [i for i in RANKS if i != 0]
+	return [dict(
+		channel_id=SCRATCH_ID, user_id=user_id, nick=f"player{user_id}",
+		rating=random.choice(rank_ratings) if user_id % 3 == 0 else random.randint(700, 2600),
+		deviation=random.randint(50, 300)
+	) for user_id in range(1, players+1)]
+
+
+def old_floors(ranks, lowest, ratings):
+	return [max([i for i in ranks if i <= rating] + [lowest]) for rating in ratings]
+
+
+def new_floors(ranks, lowest, ratings):
+	floors = []
+	for rating in ratings:
+		i = bisect_right(ranks, rating)
+		floors.append(ranks[i-1] if i else lowest)
+	return floors
+
+
+async def old_snap_ratings(db, rating, ranks_table):
+	""" snap_ratings() before the bisect lookup and the narrow updates """
+	ranks = [i['rating'] for i in ranks_table if i['rating'] != 0]
+	lowest = min(ranks)
+	data = await db.select(('*',), rating.table, where=dict(channel_id=rating.channel_id))
+	history = []
+	now = int(time.time())
+	for p in (p for p in data if p['rating'] is not None):
+		new_rating = max([i for i in ranks if i <= p['rating']] + [lowest])
+		history.append(dict(
+			user_id=p['user_id'], channel_id=rating.channel_id, at=now, rating_before=p['rating'],
+			rating_change=new_rating - p['rating'], deviation_before=p['deviation'], deviation_change=0,
+			match_id=None, reason="ratings snap"
+		))
+		p['rating'] = new_rating
+	await db.insert_many(rating.table, data, on_dublicate='replace')
+	await db.insert_many('qc_rating_history', history)
+
+
+async def old_reset(db, rating):
+	""" reset() before reading only the rated players """
+	data = await db.select(('user_id', 'rating', 'deviation'), rating.table, where=dict(channel_id=rating.channel_id))
+	history = []
+	now = int(time.time())
+	for p in data:
+		if p['rating'] is not None and (p['rating'] != rating.init_rp or p['deviation'] != rating.init_deviation):
+			history.append(dict(
+				user_id=p['user_id'], channel_id=rating.channel_id, at=now, rating_before=p['rating'],
+				rating_change=rating.init_rp-p['rating'], deviation_before=p['deviation'],
+				deviation_change=rating.init_deviation-p['deviation'], match_id=None, reason="ratings reset"
+			))
+	await db.update(rating.table, dict(rating=None, deviation=None), keys=dict(channel_id=rating.channel_id))
+	if len(history):
+		await db.insert_many('qc_rating_history', history)
+
+
+def cpu(players):
+	ranks = sorted(i for i in RANKS if i != 0)
+	ratings = [p['rating'] for p in players_rows(players)]
+	assert old_floors(ranks, ranks[0], ratings) == new_floors(ranks, ranks[0], ratings)
+	print(f"Rank floor lookups of {players} players, {len(ranks)} ranks:")
+	print_table(["old ms", "bisect ms"], [[
+		ms(measure(old_floors, ranks, ranks[0], ratings, repeat=3)), ms(measure(new_floors, ranks, ranks[0], ratings))
+	]])
+
+
+async def main(players):
+	db = await connect()
+	from bot.stats.rating import FlatRating, cache
+
+	rating = FlatRating(channel_id=SCRATCH_ID)
+	ranks_table = [dict(rating=i) for i in RANKS]
+	rows = players_rows(players)
+	runs = (
+		("snap, old", lambda: old_snap_ratings(db, rating, ranks_table)),
+		("snap", lambda: rating.snap_ratings(ranks_table)),
+		("reset, old", lambda: old_reset(db, rating)),
+		("reset", lambda: rating.reset())
+	)
+
+	results = []
+	try:
+		for name, func in runs:
+			best = None
+			for _ in range(3):
+				await db.delete('qc_players', where={'channel_id': SCRATCH_ID})
+				await db.delete('qc_rating_history', where={'channel_id': SCRATCH_ID})
+				await insert_blocks(db, 'qc_players', rows)
+				cache.drop(SCRATCH_ID)
+				started = perf_counter()
+				await func()
+				took = perf_counter() - started
+				best = took if best is None else min(best, took)
+			results.append([name, ms(best)])
+	finally:
+		cache.drop(SCRATCH_ID)
+		await db.delete('qc_players', where={'channel_id': SCRATCH_ID})
+		await db.delete('qc_rating_history', where={'channel_id': SCRATCH_ID})
+
+	print(f"Ratings snap and reset of {players} players, best of 3 runs:")
+	print_table(["operation", "ms"], results)
+
+
+if __name__ == '__main__':
+	args = [i for i in sys.argv[1:] if not i.startswith('--')]
+	players = int(args[0]) if args else 100000
+	cpu(players)
+	if '--cpu' not in sys.argv:
+		run(main(players))
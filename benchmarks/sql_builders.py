@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Per call overhead of the select(), insert(), update() and delete() db helpers with the memoized statement
+builders against the same builders without the cache. Statements are not sent, no database is needed.
+python -m benchmarks.sql_builders [calls]
+"""
+import sys
+
+from benchmarks.common import ameasure, us, print_table, run
+from core.DBAdapters.mysql import Queries
+
+
+class Null(Queries):
+	""" Helpers without a database, statements are dropped """
+
+	async def execute(self, *args):
+		return None
+
+	async def executemany(self, *args):
+		return None
+
+	async def fetchone(self, *args):
+		return None
+
+	async def fetchall(self, *args):
+		return []
+
+
+class Uncached(Null):
+	""" Statements are built on every call as before the builders were memoized """
+
+	_mysql_insert = staticmethod(Queries._mysql_insert.__wrapped__)
+	_mysql_update = staticmethod(Queries._mysql_update.__wrapped__)
+	_mysql_select = staticmethod(Queries._mysql_select.__wrapped__)
+	_mysql_delete = staticmethod(Queries._mysql_delete.__wrapped__)
+
+
+CALLS = (
+	(
+		"select, noadds.get_user()", lambda q: q.select(
+			['duration', 'at'], 'noadds', where=dict(guild_id=1, user_id=2, is_active=1)
+		)
+	),
+	(
+		"select, order and limit", lambda q: q.select(
+			['at', 'rating_change'], 'qc_rating_history', where=dict(user_id=1, channel_id=2), order_by='id', limit=10
+		)
+	),
+	(
+		"insert, 6 columns", lambda q: q.insert(
+			'qc_player_matches', dict(match_id=1, channel_id=2, user_id=3, nick="nick", team=0, at=4)
+		)
+	),
+	(
+		"update, players.expire", lambda q: q.update('players', dict(expire=60), keys=dict(user_id=1))
+	),
+	("delete", lambda q: q.delete('qc_phrases', where=dict(channel_id=1, user_id=2)))
+)
+
+
+async def main(calls):
+	rows = []
+	for name, call in CALLS:
+		times = []
+		for queries in (Uncached(), Null()):
+			times.append(await ameasure(call, queries, number=calls))
+		rows.append([name, us(times[0]), us(times[1]), f"{times[0] / times[1]:.1f}x"])
+
+	print(f"Helper call overhead, best of 5 runs of {calls} calls:")
+	print_table(["helper", "uncached us", "memoized us", "speedup"], rows)
+
+
+if __name__ == '__main__':
+	run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
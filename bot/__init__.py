@@ -2,7 +2,8 @@
 
 from .main import update_qc_lang, update_rating_system, save_state
 from .main import load_state, enable_channel, disable_channel
-from .main import remove_players, expire_auto_ready
+from .main import remove_players, expire_auto_ready, get_queue_channel
+from .main import channel_ready, channels_progress
 
 from .queue_channel import QueueChannel
 from .queues.pickup_queue import PickupQueue
@@ -21,6 +22,8 @@ from . import utils
 bot_was_ready = False
 bot_ready = False
 queue_channels = dict()  # {channel.id: QueueChannel()}
+queue_channel_stubs = dict()  # {channel.id: dict(guild_id, qc_row, pq_rows)} of channels not loaded yet
+restoring_channels = set()  # {channel.id} of channels waiting for their saved state
 active_queues = []
 active_matches = []
 waiting_reactions = dict()  # {message.id: function}
@@ -1,14 +1,17 @@
 __all__ = [
 	'noadds', 'noadd', 'forgive', 'rating_seed', 'rating_penality', 'rating_hide',
-	'rating_reset', 'rating_snap', 'stats_reset', 'stats_reset_player', 'stats_replace_player',
+	'rating_reset', 'rating_snap', 'rating_rebuild', 'stats_reset', 'stats_reset_player', 'stats_replace_player',
 	'phrases_add', 'phrases_clear', 'undo_match'
 ]
 
+import asyncio
+import traceback
 from time import time
 from datetime import timedelta
 from nextcord import Member
 
 from core.utils import seconds_to_str, get_nick
+from core.console import log
 
 import bot
 
@@ -97,6 +100,73 @@ async def rating_snap(ctx):
 	await ctx.success(ctx.qc.gt("Done."))
 
 
+async def rating_rebuild(ctx, dry_run: bool = False, discard_history: bool = False):
+	ctx.check_perms(ctx.Perms.ADMIN)
+	rating = ctx.qc.rating
+	rebuilds = bot.stats.rating.rebuilds
+	if rating.channel_id in rebuilds:
+		raise bot.Exc.ValueError(ctx.qc.gt("Ratings are already being rebuilt."))
+	if not dry_run and not discard_history and (count := await rating.count_manual_history()):
+		raise bot.Exc.ValueError(ctx.qc.gt(
+			"Rebuilding will discard {count} non-match rating changes (seeds, penalties, decay), " +
+			"set discard_history to confirm."
+		).format(count=count))
+
+	# The rebuild may take longer than the interaction lifetime, report to the channel instead
+	task = rebuilds[rating.channel_id] = asyncio.create_task(
+		_rating_rebuild_job(bot.SystemContext(ctx.qc), rating, dry_run, discard_history)
+	)
+	task.add_done_callback(lambda t: rebuilds.pop(rating.channel_id, None))
+	await ctx.reply(ctx.qc.gt("Rebuilding ratings in the background, the progress will be reported in this channel."))
+
+
+async def _rating_rebuild_job(ctx, rating, dry_run, discard_history):
+	reported = [0]
+
+	async def progress(done, total):
+		log.info(f"Rebuilding ratings for channel {rating.channel_id}: {done}/{total} matches.")
+		if done * 4 // total > reported[0] and done != total:
+			reported[0] = done * 4 // total
+			await ctx.notice(ctx.qc.gt("Rebuilding ratings: {done}/{total} matches replayed...").format(
+				done=done, total=total
+			))
+
+	try:
+		result = await rating.rebuild(progress=progress, dry_run=dry_run, discard_history=discard_history)
+	except Exception as e:
+		log.error(f"Failed to rebuild ratings for channel {rating.channel_id}: {str(e)}\n{traceback.format_exc()}")
+		await ctx.error(ctx.qc.gt("Failed to rebuild ratings, no changes have been made."))
+		return
+	if result is None:
+		await ctx.error(ctx.qc.gt(
+			"Non-match rating changes have been added since the rebuild started, set discard_history to confirm."
+		))
+		return
+
+	changes, mismatches = result
+	changed = sorted(
+		((user_id, before, after) for user_id, (before, after) in changes.items() if before != after),
+		key=lambda i: abs((i[2] or 0) - (i[1] or 0)), reverse=True
+	)
+	text = ctx.qc.gt("{changed} of {total} players ratings {verb}.").format(
+		changed=len(changed), total=len(changes),
+		verb=ctx.qc.gt("would change") if dry_run else ctx.qc.gt("have been changed")
+	)
+	if len(changed):
+		text += "\n" + "\n".join((
+			f"<@{user_id}>: {'-' if before is None else before} ⟼ {'-' if after is None else after}" for user_id, before, after in changed[:10]
+		))
+	if len(mismatches):
+		log.error(f"Rating engine replay mismatches for channel {rating.channel_id}, matches: {mismatches}.")
+		text += "\n" + ctx.qc.gt("Warning: the replay differs from the reference in {count} matches.").format(
+			count=len(mismatches)
+		)
+	if dry_run:
+		await ctx.reply(text)
+	else:
+		await ctx.success(text)
+
+
 async def stats_reset(ctx):
 	ctx.check_perms(ctx.Perms.ADMIN)
 	await bot.stats.reset_channel(ctx.qc.id)
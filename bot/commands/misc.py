@@ -7,6 +7,7 @@ from random import randint
 from core.utils import seconds_to_str, find
 from core.database import db
 from core.config import cfg
+from core.scheduler import scheduler
 
 import bot
 
@@ -28,6 +29,7 @@ async def auto_ready(ctx, duration: timedelta = None):
 		return
 
 	bot.auto_ready[ctx.author.id] = int(time()) + duration.total_seconds()
+	scheduler.set(('auto_ready', ctx.author.id), bot.auto_ready[ctx.author.id], bot.expire_auto_ready)
 	await ctx.success(
 		ctx.qc.gt("During next {duration} your match participation will be confirmed automatically.").format(
 			duration=duration.__str__()
@@ -112,17 +112,12 @@ async def rank(ctx, player: Member = None):
 	if not target:
 		raise bot.Exc.SyntaxError(ctx.qc.gt("Specified user not found."))
 
-	data = await ctx.qc.get_lb()
+	lb = await ctx.qc.get_lb()
 	# Figure out leaderboard placement
-	if p := find(lambda i: i['user_id'] == target.id, data):
-		place = data.index(p) + 1
+	if place := lb.place(target.id):
+		p = lb.get(target.id)
 	else:
-		data = await db.select(
-			['user_id', 'rating', 'deviation', 'channel_id', 'wins', 'losses', 'draws', 'is_hidden', 'streak'],
-			"qc_players",
-			where={'channel_id': ctx.qc.rating.channel_id}
-		)
-		p = find(lambda i: i['user_id'] == target.id, data)
+		p = await ctx.qc.rating.get_row(target.id)
 		place = "?"
 
 	if p:
@@ -170,9 +165,9 @@ async def rank(ctx, player: Member = None):
 async def leaderboard(ctx, page: int = 1):
 	page = (page or 1) - 1
 
-	data = await ctx.qc.get_lb()
-	pages = ceil(len(await ctx.qc.get_lb())/10)
-	data = data[page * 10:(page + 1) * 10]
+	lb = await ctx.qc.get_lb()
+	pages = ceil(len(lb)/10)
+	data = lb.page(page * 10, (page + 1) * 10)
 	if not len(data):
 		raise bot.Exc.NotFoundError(ctx.qc.gt("Leaderboard is empty."))
 
@@ -128,14 +128,15 @@ class SystemContext(Context):
 
 
 class WebContext(Context):
-	""" Context for actions within the web interface """
+	""" Context for actions within the web interface, created with await WebContext.create() """
 
-	def __init__(self, user_id: int, channel_id: int):
-		if (qc := bot.queue_channels.get(channel_id)) is None:
+	@classmethod
+	async def create(cls, user_id: int, channel_id: int):
+		if (qc := await bot.get_queue_channel(channel_id)) is None:
 			raise bot.Exc.NotFoundError(f"QueueChannel with id {channel_id} is not found.")
 		if (channel := dc.get_channel(channel_id)) is None:
 			raise bot.Exc.NotFoundError(f"Discord Channel object with id {channel_id} is not reachable.")
 		if (author := channel.guild.get_member(user_id)) is None:
 			raise bot.Exc.NotFoundError(f"You are not a member of requested guild.")
 
-		super().__init__(qc, channel, author)
+		return cls(qc, channel, author)
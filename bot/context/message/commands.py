@@ -31,7 +31,7 @@ async def on_message(message):
 	if not message.content or message.content == "":
 		return
 
-	if (qc := bot.queue_channels.get(message.channel.id)) is None:
+	if (qc := await bot.get_queue_channel(message.channel.id)) is None:
 		return
 
 	# special commands
@@ -58,7 +58,7 @@ async def on_message(message):
 			ctx.channel.guild.name, ctx.channel.name, get_nick(message.author), message.content
 		))
 
-		if not bot.bot_ready:
+		if not bot.channel_ready(qc.id):
 			await ctx.error("Bot is under connection, please try agian later...", title="Error")
 			return
 
@@ -34,22 +34,37 @@ async def run_slash(coro: Callable, interaction: Interaction, **kwargs):
 		log.error('Skipping an outdated interaction.')
 		return
 
+	async def error(text):
+		if interaction.response.is_done():
+			await interaction.followup.send(embed=error_embed(text, title="Error"))
+		else:
+			await interaction.response.send_message(embed=error_embed(text, title="Error"))
+
+	# Queue channels are not known until the bot is ready
 	if not bot.bot_ready:
-		await interaction.response.send_message(
-			embed=error_embed("Bot is under connection, please try agian later...", title="Error")
-		)
+		await error("Bot is under connection, please try agian later...")
 		return
-	qc = bot.queue_channels.get(interaction.channel_id)
-	if qc is None:
-		await interaction.response.send_message(embed=error_embed("Not in a queue channel.", title="Error"))
+
+	if (qc := bot.queue_channels.get(interaction.channel_id)) is None:
+		if interaction.channel_id not in bot.queue_channel_stubs.keys():
+			await error("Not in a queue channel.")
+			return
+		# Loading the channel takes database queries, they must not eat the interaction response time
+		await interaction.response.defer()
+		if (qc := await bot.get_queue_channel(interaction.channel_id)) is None:
+			await error("Not in a queue channel.")
+			return
+	if not bot.channel_ready(qc.id):
+		await error("Bot is under connection, please try agian later...")
 		return
 
 	ctx = SlashContext(qc, interaction)
 	try:
 		await wait_for(shield(run_slash_coro(ctx, coro, **kwargs)), timeout=max(2.5 - passed_time, 0))
 	except (TimeoutError, aTimeoutError):
-		log.info('Deferring /slash command')
-		await interaction.response.defer()
+		if not interaction.response.is_done():
+			log.info('Deferring /slash command')
+			await interaction.response.defer()
 
 
 async def run_slash_coro(ctx: SlashContext, coro: Callable, **kwargs):
@@ -178,7 +193,11 @@ async def enable_channel(
 		return await interaction.response.send_message(
 			embed=error_embed('You must possess server administrator permissions.'), ephemeral=True
 		)
-	if bot.queue_channels.get(interaction.channel_id) is not None:
+	if not bot.bot_ready:  # channels are not registered yet, an enabled one would be created again
+		return await interaction.response.send_message(
+			embed=error_embed('Bot is under connection, please try agian later...'), ephemeral=True
+		)
+	if await bot.get_queue_channel(interaction.channel_id) is not None:
 		return await interaction.response.send_message(
 			embed=error_embed('This channel is already enabled.'), ephemeral=True
 		)
@@ -195,7 +214,7 @@ async def disable_channel(
 		return await interaction.response.send_message(
 			embed=error_embed('You must possess server administrator permissions.'), ephemeral=True
 		)
-	if (qc := bot.queue_channels.get(interaction.channel_id)) is None:
+	if (qc := await bot.get_queue_channel(interaction.channel_id)) is None:
 		return await interaction.response.send_message(
 			embed=error_embed('This channel is not enabled.'), ephemeral=True
 		)
@@ -212,7 +231,7 @@ async def delete_channel(
 		return await interaction.response.send_message(
 			embed=error_embed('You must possess server administrator permissions.'), ephemeral=True
 		)
-	if (qc := bot.queue_channels.get(interaction.channel_id)) is None:
+	if (qc := await bot.get_queue_channel(interaction.channel_id)) is None:
 		return await interaction.response.send_message(
 			embed=error_embed('This channel is not enabled.'), ephemeral=True
 		)
@@ -377,6 +396,18 @@ async def _rating_snap(
 ): await run_slash(bot.commands.rating_snap, interaction=interaction)
 
 
+@groups.admin_rating.subcommand(name='rebuild', description='Recalculate ratings from the matches history.')
+async def _rating_rebuild(
+		interaction: Interaction,
+		dry_run: bool = SlashOption(required=False, default=False),
+		discard_history: bool = SlashOption(
+			required=False, default=False, description="Confirm dropping seeds, penalties and decay from the history."
+		)
+): await run_slash(
+	bot.commands.rating_rebuild, interaction=interaction, dry_run=dry_run, discard_history=discard_history
+)
+
+
 # stats -> ...
 
 @groups.admin_stats.subcommand(name='show', description='Show channel or player stats.')
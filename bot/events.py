@@ -1,4 +1,4 @@
-import traceback
+from collections import defaultdict
 from nextcord import ChannelType, Activity, ActivityType
 
 from core.client import dc
@@ -10,25 +10,12 @@ import bot
 @dc.event
 async def on_init():
 	await bot.stats.check_match_id_counter()
+	await bot.noadds.schedule_next()
 
 
 @dc.event
-async def on_think(frame_time):
-	for match in bot.active_matches:
-		try:
-			await match.think(frame_time)
-		except Exception as e:
-			log.error("\n".join([
-				f"Error at Match.think().",
-				f"match_id: {match.id}).",
-				f"{str(e)}. Traceback:\n{traceback.format_exc()}=========="
-			]))
-			bot.active_matches.remove(match)
-			break
-	await bot.expire.think(frame_time)
-	await bot.noadds.think(frame_time)
-	await bot.stats.jobs.think(frame_time)
-	await bot.expire_auto_ready(frame_time)
+async def on_exit():
+	await bot.stats.match_ids.release()
 
 
 @dc.event
@@ -63,19 +50,29 @@ async def on_ready():
 	if not bot.bot_was_ready:  # Connected for the first time, load everything
 		log.info(f"Logged in discord as '{dc.user.name}#{dc.user.discriminator}'.")
 		log.info("Loading queue channels...")
-		for channel_id in await bot.QueueChannel.cfg_factory.p_keys():
+		# Fetch all configs at once and group queues by channel
+		pq_rows = defaultdict(list)
+		for row in await bot.PickupQueue.cfg_factory.select_rows():
+			pq_rows[row['channel_id']].append(row)
+
+		for qc_row in await bot.QueueChannel.cfg_factory.select_rows():
+			channel_id = qc_row['channel_id']
 			channel = dc.get_channel(channel_id)
-			if channel:
-				bot.queue_channels[channel_id] = await bot.QueueChannel.create(channel)
-				await bot.queue_channels[channel_id].update_info(channel)
-				log.info(f"\tInit channel {channel.guild.name}>#{channel.name} successful.")
+			if channel:  # Register a stub, the channel is loaded on the first use by bot.get_queue_channel()
+				bot.queue_channel_stubs[channel_id] = dict(
+					guild_id=channel.guild.id, qc_row=qc_row, pq_rows=pq_rows[channel_id]
+				)
 			else:
-				log.info(f"\tCould not reach a text channel with id {channel_id}.")
+				log.debug(f"\tCould not reach a text channel with id {channel_id}.")
+		log.info(f"Registered {len(bot.queue_channel_stubs)} queue channels.")
 
-		await bot.load_state()
+		# Channels are accepting commands from now on, except ones waiting for their saved state
 		bot.bot_was_ready = True
 		bot.bot_ready = True
-		log.info("Done.")
+		await bot.load_state(max_concurrent=getattr(cfg, 'STARTUP_CONCURRENCY', 8))
+		log.info("Done, {}/{} queue channels are loaded, the rest will be loaded on demand.".format(
+			*bot.channels_progress()
+		))
 	else:  # Reconnected, fetch new channel objects
 		bot.bot_ready = True
 		log.info("Reconnected to discord.")
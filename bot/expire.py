@@ -1,6 +1,9 @@
 import time
+import heapq
+from itertools import count
 
 from core.client import dc
+from core.scheduler import scheduler
 
 import bot
 
@@ -11,7 +14,8 @@ class ExpireTimer:
 
 	def __init__(self):
 		self.tasks = dict()  # hash: Task()
-		self.next = None     # Task()
+		self.heap = []       # [(at, n, Task())], cancelled and replaced tasks are skipped on pop
+		self._counter = count()
 
 	def serialize(self):
 		return [t.serialize() for t in self.tasks.values()]
@@ -20,10 +24,9 @@ class ExpireTimer:
 		for task_data in data:
 			try:
 				task = await self.ExpireTask.from_json(task_data)
-				self.tasks[task.hash] = task
+				self._push(task)
 			except bot.Exc.ValueError as e:
 				log.error(f"Failed to load expire task '{data}': {str(e)}")
-		self._define_next()
 
 	class ExpireTask:
 
@@ -38,7 +41,7 @@ class ExpireTimer:
 
 		@classmethod
 		async def from_json(cls, data):
-			if (qc := bot.queue_channels.get(data['channel_id'])) is None:
+			if (qc := await bot.get_queue_channel(data['channel_id'])) is None:
 				raise bot.Exc.ValueError(f"QueueChannel is not found.")
 			if (guild := dc.get_guild(qc.guild_id)) is None:
 				raise bot.Exc.ValueError(f"Guild is not reachable.")
@@ -48,35 +51,54 @@ class ExpireTimer:
 
 	def set(self, qc, member, delay):
 		new_task = self.ExpireTask(qc, member, int(time.time()+delay))
-		self.tasks[new_task.hash] = new_task
+		self._push(new_task)
 		log.debug(f"EXPIRE TIMER SET > {member.name} ({qc.id}/{member.id}) to {delay}")
-		self._define_next()
+
+	def _push(self, task):
+		self.tasks[task.hash] = task
+		heapq.heappush(self.heap, (task.at, next(self._counter), task))
+		if (at := scheduler.get('expire')) is None or task.at < at:
+			scheduler.set('expire', task.at, self.think)
+		# Drop stale entries if cancelled tasks pile up
+		if len(self.heap) > 2 * len(self.tasks) + 64:
+			self.heap = [(t.at, next(self._counter), t) for t in self.tasks.values()]
+			heapq.heapify(self.heap)
 
 	def get(self, qc, member):
 		return self.tasks.get(str(qc.id) + "_" + str(member.id))
 
-	def _define_next(self):
-		if len(self.tasks):
-			self.next = sorted(self.tasks.values(), key=lambda task: task.at)[0]
-			log.debug(f"EXPIRE TIMER NEXT > {self.next.member.name} ({self.next.qc.id}/{self.next.member.id})")
-		else:
-			self.next = None
-
 	def cancel(self, qc, member):
 		key = str(qc.id) + "_" + str(member.id)
 		if key in self.tasks.keys():
 			task = self.tasks.pop(key)
 			log.debug(f"EXPIRE TIMER CANCEL > {task.member.name} ({task.qc.id}/{task.member.id})")
-			if self.next and self.next.hash == key:
-				self._define_next()
+
+	def _pop_overdue(self, frame_time):
+		""" Remove and return all tasks which time has come """
+		overdue = []
+		while len(self.heap) and self.heap[0][0] <= frame_time:
+			at, n, task = heapq.heappop(self.heap)
+			if self.tasks.get(task.hash) is task:
+				self.tasks.pop(task.hash)
+				overdue.append(task)
+		return overdue
 
 	async def think(self, frame_time):
-		if self.next and frame_time >= self.next.at:
-			task = self.tasks.pop(self.next.hash)
+		by_qc = dict()  # {qc: [member]}
+		for task in self._pop_overdue(frame_time):
 			log.debug(f"EXPIRE TIMER TRIGGER > {task.member.name} ({task.qc.id}/{task.member.id})")
-			self._define_next()
 			if task.qc and task.member:
-				await task.qc.remove_members(task.member, reason="expire", highlight=True)
+				by_qc.setdefault(task.qc, []).append(task.member)
+
+		if len(self.heap):
+			scheduler.set('expire', self.heap[0][0], self.think)
+
+		# The tasks are already popped, a failing channel must not keep members of the others in the queues
+		for qc, members in by_qc.items():
+			try:
+				await qc.remove_members(*members, reason="expire", highlight=True)
+			except Exception as e:
+				log.error(f"Failed to expire members on channel {qc.id}: {str(e)}")
 
 
 expire = ExpireTimer()
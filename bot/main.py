@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 import traceback
 import json
+import asyncio
 from nextcord import Interaction
 
+from core.client import dc
 from core.console import log
 from core.database import db
 from core.config import cfg
@@ -11,13 +13,49 @@ from core.utils import error_embed, ok_embed, get
 import bot
 
 
+_hydrating = dict()  # {channel.id: asyncio.Task} of QueueChannels being loaded
+
+
+async def get_queue_channel(channel_id):
+	"""
+	Return QueueChannel by its channel id or None if the bot is not enabled on the channel.
+	Channels registered as stubs at startup are loaded on the first access, concurrent calls share the same load.
+	"""
+	if (qc := bot.queue_channels.get(channel_id)) is not None:
+		return qc
+	if channel_id not in bot.queue_channel_stubs.keys():
+		return None
+
+	if (task := _hydrating.get(channel_id)) is None:
+		task = _hydrating[channel_id] = asyncio.create_task(_hydrate(channel_id))
+	return await asyncio.shield(task)
+
+
+async def _hydrate(channel_id):
+	try:
+		if (channel := dc.get_channel(channel_id)) is None:
+			return None
+		stub = bot.queue_channel_stubs[channel_id]
+		qc = await bot.QueueChannel.load(channel, dict(stub['qc_row']), [dict(row) for row in stub['pq_rows']])
+		bot.queue_channels[channel_id] = qc
+		bot.queue_channel_stubs.pop(channel_id)
+	finally:
+		_hydrating.pop(channel_id)
+
+	# Rating channel ranks are looked up synchronously
+	if qc.cfg.rating_channel and qc.cfg.rating_channel.id != channel_id:
+		await get_queue_channel(qc.cfg.rating_channel.id)
+	await qc.update_info(channel)
+	return qc
+
+
 async def enable_channel(message):
 	if not (message.author.id == cfg.DC_OWNER_ID or message.channel.permissions_for(message.author).administrator):
 		await message.channel.send(embed=error_embed(
 			"One must posses the guild administrator permissions in order to use this command."
 		))
 		return
-	if message.channel.id not in bot.queue_channels.keys():
+	if await get_queue_channel(message.channel.id) is None:
 		bot.queue_channels[message.channel.id] = await bot.QueueChannel.create(message.channel)
 		await message.channel.send(embed=ok_embed("The bot has been enabled."))
 	else:
@@ -32,7 +70,7 @@ async def disable_channel(message):
 			"One must posses the guild administrator permissions in order to use this command."
 		))
 		return
-	qc = bot.queue_channels.get(message.channel.id)
+	qc = await get_queue_channel(message.channel.id)
 	if qc:
 		for queue in qc.queues:
 			await queue.cfg.delete()
@@ -68,17 +106,25 @@ def save_state():
 	f.close()
 
 
-async def load_state():
-	try:
-		with open("saved_state.json", "r") as f:
-			data = json.loads(f.read())
-	except IOError:
-		return
+def channel_ready(channel_id):
+	""" Return True if the channel is accepting commands """
+	return bot.bot_ready and channel_id not in bot.restoring_channels
 
-	log.info("Loading state...")
 
-	bot.allow_offline = list(data['allow_offline'])
+def channels_progress():
+	""" Return (loaded, total) count of enabled QueueChannels """
+	return len(bot.queue_channels), len(bot.queue_channels) + len(bot.queue_channel_stubs)
+
+
+def _channel_guild_id(channel_id):
+	if (qc := bot.queue_channels.get(channel_id)) is not None:
+		return qc.guild_id
+	if (stub := bot.queue_channel_stubs.get(channel_id)) is not None:
+		return stub['guild_id']
+	return None
 
+
+async def _load_guild_state(data):
 	for qd in data['queues']:
 		if qd.get('queue_type') in ['PickupQueue', None]:
 			try:
@@ -94,8 +140,49 @@ async def load_state():
 		except bot.Exc.ValueError as e:
 			log.error(f"Failed to load match {md['match_id']}: {str(e)}")
 
-	if 'expire' in data.keys():
-		await bot.expire.load_json(data['expire'])
+	await bot.expire.load_json(data['expire'])
+
+
+async def load_state(max_concurrent=8):
+	"""
+	Restore saved queues, matches and expire tasks, guilds are restored concurrently.
+	Channels with a saved state do not accept commands until their guild is restored, see channel_ready().
+	"""
+	try:
+		with open("saved_state.json", "r") as f:
+			data = json.loads(f.read())
+	except IOError:
+		return
+
+	log.info("Loading state...")
+
+	bot.allow_offline = list(data['allow_offline'])
+
+	guilds = dict()  # {guild_id: dict(queues, matches, expire)}
+	for key in ('queues', 'matches', 'expire'):
+		for item in data.get(key, []):
+			guild_id = _channel_guild_id(item['channel_id'])
+			guilds.setdefault(guild_id, dict(queues=[], matches=[], expire=[]))[key].append(item)
+			bot.restoring_channels.add(item['channel_id'])
+
+	semaphore = asyncio.Semaphore(max_concurrent)
+	restored = 0
+
+	async def restore(guild_id, guild_data):
+		nonlocal restored
+		async with semaphore:
+			try:
+				await _load_guild_state(guild_data)
+			except Exception as e:
+				log.error(f"Failed to load state of guild {guild_id}: {str(e)}")
+			finally:
+				for key in ('queues', 'matches', 'expire'):
+					bot.restoring_channels.difference_update((item['channel_id'] for item in guild_data[key]))
+				restored += 1
+				log.debug(f"\tRestored state of guild {guild_id} ({restored}/{len(guilds)}).")
+
+	await asyncio.gather(*(restore(guild_id, guild_data) for guild_id, guild_data in guilds.items()))
+	bot.restoring_channels.clear()
 
 
 async def remove_players(*users, reason=None):
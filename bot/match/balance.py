@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+from time import perf_counter
+from bisect import bisect_left
+import heapq
+
+EXACT_LIMIT = 24  # max players count for the exact search, 30 players take over 100ms
+
+
+def balance_teams(values, team_len, time_budget=0.5):
+	"""
+	Pick team_len of the given values which sum is the closest to a half of the total sum.
+	Returns a sorted list of the picked indexes.
+	Exact meet-in-the-middle search is used for up to EXACT_LIMIT values, otherwise a differencing heuristic
+	improved by a local search until the time_budget (in seconds) runs out.
+	"""
+	if team_len <= 0:
+		return []
+	if team_len >= len(values):
+		return list(range(len(values)))
+
+	if len(values) <= EXACT_LIMIT:
+		return _exact(values, team_len)
+
+	deadline = perf_counter() + time_budget
+	if len(values) - team_len * 2 in (0, 1):
+		team = _differencing(values, team_len)
+	else:
+		team = _greedy(values, team_len)
+	return sorted(_local_search(values, team, deadline))
+
+
+def _subset_sums(values, indexes):
+	""" Return {size: [(sum, mask)]} for all subsets of the given indexes """
+	subsets = [(0, 0, 0)]  # (size, sum, mask)
+	for i in indexes:
+		subsets += [(size + 1, total + values[i], mask | (1 << i)) for size, total, mask in subsets]
+
+	by_size = dict()
+	for size, total, mask in subsets:
+		by_size.setdefault(size, []).append((total, mask))
+	return by_size
+
+
+def _exact(values, team_len):
+	""" Meet-in-the-middle over the two halves of values, O(2^(n/2) * n) """
+	target = sum(values) / 2
+	middle = len(values) // 2
+	left = _subset_sums(values, range(middle))
+	right = _subset_sums(values, range(middle, len(values)))
+	for subsets in right.values():
+		subsets.sort()
+
+	best, best_mask = None, 0
+	for size, subsets in left.items():
+		if (candidates := right.get(team_len - size)) is None:
+			continue
+		sums = [total for total, mask in candidates]
+		for total, mask in subsets:
+			pos = bisect_left(sums, target - total)
+			for j in (pos - 1, pos):
+				if 0 <= j < len(candidates):
+					diff = abs(total + candidates[j][0] - target)
+					if best is None or diff < best:
+						best, best_mask = diff, mask | candidates[j][1]
+		if best == 0:
+			break
+
+	return [i for i in range(len(values)) if best_mask & (1 << i)]
+
+
+def _differencing(values, team_len):
+	"""
+	Balanced largest differencing (Karmarkar-Karp) for team_len of len(values) // 2.
+	On odd values count a zero valued dummy evens out the sides and marks the smaller team.
+	"""
+	items = [(v, i) for i, v in enumerate(values)]
+	if len(items) % 2:
+		items.append((0, None))
+	items.sort(key=lambda item: item[0], reverse=True)
+
+	# Pair neighbours, each pair is a partial partition (-difference, n, bigger side, smaller side)
+	heap = []
+	for n in range(0, len(items), 2):
+		(v1, i1), (v2, i2) = items[n], items[n + 1]
+		heap.append((-(v1 - v2), n, [i1], [i2]))
+	heapq.heapify(heap)
+
+	# Join two most different partitions by putting the bigger side of one with the smaller side of another
+	while len(heap) > 1:
+		d1, n, big1, small1 = heapq.heappop(heap)
+		d2, _, big2, small2 = heapq.heappop(heap)
+		heapq.heappush(heap, (d1 - d2, n, big1 + small2, small1 + big2))
+
+	_, _, side1, side2 = heap[0]
+	team = side2 if None in side2 else side1
+	return [i for i in team if i is not None]
+
+
+def _greedy(values, team_len):
+	""" Give each value, biggest first, to the team while its sum stays below a half of the total """
+	target = sum(values) / 2
+	rest_len = len(values) - team_len
+	team, team_sum, rest_count = [], 0, 0
+	for i in sorted(range(len(values)), key=lambda i: values[i], reverse=True):
+		if len(team) < team_len and (rest_count == rest_len or team_sum + values[i] <= target):
+			team.append(i)
+			team_sum += values[i]
+		else:
+			rest_count += 1
+	return team
+
+
+def _local_search(values, team, deadline):
+	""" Swap team members with the rest while it brings the team sum closer to a half of the total """
+	target = sum(values) / 2
+	team = set(team)
+	team_sum = sum(values[i] for i in team)
+
+	while perf_counter() < deadline and team_sum != target:
+		rest = sorted((values[j], j) for j in range(len(values)) if j not in team)
+		rest_values = [v for v, j in rest]
+		best, best_swap = abs(team_sum - target), None
+		for i in team:
+			# The best replacement for i has value of target - (team_sum - values[i])
+			pos = bisect_left(rest_values, target - team_sum + values[i])
+			for k in (pos - 1, pos):
+				if 0 <= k < len(rest):
+					diff = abs(team_sum - values[i] + rest[k][0] - target)
+					if diff < best:
+						best, best_swap = diff, (i, rest[k][1])
+		if best_swap is None:
+			break
+		i, j = best_swap
+		team.remove(i)
+		team.add(j)
+		team_sum += values[j] - values[i]
+
+	return team
@@ -1,17 +1,21 @@
 # -*- coding: utf-8 -*-
-from time import time
-from itertools import combinations
+from time import time, perf_counter
 import random
+import traceback
+import asyncio
 from nextcord import DiscordException
 
 import bot
 from core.utils import find, get, iter_to_dict, join_and, get_nick
 from core.console import log
 from core.client import dc
+from core.scheduler import scheduler
+from core.workers import workers
 
 from .check_in import CheckIn
 from .draft import Draft
 from .embeds import Embeds
+from .balance import balance_teams
 
 
 class Match:
@@ -21,6 +25,8 @@ class Match:
 	DRAFT = 2
 	WAITING_REPORT = 3
 
+	THINK_TIMEOUT = 30
+
 	TEAM_EMOJIS = [
 		":fox:", ":wolf:", ":dog:", ":bear:", ":panda_face:", ":tiger:", ":lion:", ":pig:", ":octopus:", ":boar:",
 		":scorpion:", ":crab:", ":eagle:", ":shark:", ":bat:", ":rhino:", ":dragon_face:", ":deer:"
@@ -31,7 +37,7 @@ class Match:
 		team_size=1, pick_captains="no captains", captains_role_id=None, pick_teams="draft",
 		pick_order=None, maps=[], vote_maps=0, map_count=0, check_in_timeout=0,
 		check_in_discard=True, check_in_discard_immediately=True, match_lifetime=3*60*60, start_msg=None, server=None,
-		show_streamers=True
+		show_streamers=True, matchmaking_deviation=False, matchmaking_time_budget=0.5
 	)
 
 	class Team(list):
@@ -59,16 +65,19 @@ class Match:
 	@classmethod
 	async def new(cls, ctx, queue, players, **kwargs):
 		# Create the Match object
-		ratings = {p['user_id']: p['rating'] for p in await ctx.qc.rating.get_players((p.id for p in players))}
+		data = await ctx.qc.rating.get_players((p.id for p in players))
+		ratings = {p['user_id']: p['rating'] for p in data}
+		deviations = {p['user_id']: p['deviation'] for p in data}
 		match_id = await bot.stats.next_match()
-		match = cls(match_id, queue, ctx.qc, players, ratings, **kwargs)
+		match = cls(match_id, queue, ctx.qc, players, ratings, deviations=deviations, **kwargs)
 		# Prepare the Match object
 		match.maps = match.random_maps(match.cfg['maps'], match.cfg['map_count'], queue.last_maps)
 		match.init_captains(match.cfg['pick_captains'], match.cfg['captains_role_id'])
-		match.init_teams(match.cfg['pick_teams'])
+		await match.init_teams(match.cfg['pick_teams'])
 		if match.ranked:
 			match.states.append(match.WAITING_REPORT)
 		bot.active_matches.append(match)
+		match.schedule()
 
 	@classmethod
 	async def fake_ranked_match(cls, ctx, queue, qc, winners, losers, draw=False, **kwargs):
@@ -85,7 +94,7 @@ class Match:
 		else:
 			match.winner = 0
 			match.scores[match.winner] = 1
-		await bot.stats.register_match_ranked(ctx, match)
+		await bot.stats.register_match_ranked(ctx, match, match.winner, tuple(match.scores))
 
 	def serialize(self):
 		return dict(
@@ -103,7 +112,7 @@ class Match:
 
 	@classmethod
 	async def from_json(cls, data):
-		if (qc := bot.queue_channels.get(data['channel_id'])) is None:
+		if (qc := await bot.get_queue_channel(data['channel_id'])) is None:
 			raise bot.Exc.ValueError('QueueChannel not found.')
 		if (queue := get(qc.queues, id=data['queue_id'])) is None:
 			raise bot.Exc.ValueError('Queue not found.')
@@ -136,8 +145,9 @@ class Match:
 			await match.check_in.start(ctx)  # Spawn a new check_in message
 
 		bot.active_matches.append(match)
+		match.schedule()
 
-	def __init__(self, match_id, queue, qc, players, ratings, **cfg):
+	def __init__(self, match_id, queue, qc, players, ratings, deviations=None, **cfg):
 
 		# Set parent objects and shorthands
 		self.queue = queue
@@ -154,6 +164,7 @@ class Match:
 		self.ranked = self.cfg['ranked'] and self.cfg['pick_teams'] != 'no teams'
 		self.players = list(players)
 		self.ratings = ratings
+		self.deviations = deviations or dict()
 		self.winner = None
 		self.scores = [0, 0]
 
@@ -171,6 +182,9 @@ class Match:
 		self.lifetime = self.cfg['match_lifetime']
 		self.start_time = int(time())
 		self.state = self.INIT
+		self.think_stats = dict(count=0, total=0.0, max=0.0, last=0.0, overruns=0)  # think() latency in seconds
+		self._thinking = None  # running think() Task
+		self.finishing = False  # set while the match is being registered
 
 		# Init self sections
 		self.check_in = CheckIn(self, self.cfg['check_in_timeout'])
@@ -208,18 +222,24 @@ class Match:
 				rand, key=lambda p: self.cfg['captains_role_id'] in [role.id for role in p.roles], reverse=True
 			)[:2]
 
-	def init_teams(self, pick_teams):
+	async def init_teams(self, pick_teams):
 		if pick_teams == "draft":
 			self.teams[0].set(self.captains[:1])
 			self.teams[1].set(self.captains[1:])
 			self.teams[2].set([p for p in self.players if p not in self.captains])
 		elif pick_teams == "matchmaking":
 			team_len = min(self.cfg['team_size'], int(len(self.players)/2))
-			best_rating = sum(self.ratings.values())/2
-			best_team = min(
-				combinations(self.players, team_len),
-				key=lambda team: abs(sum([self.ratings[m.id] for m in team])-best_rating)
+			if self.cfg['matchmaking_deviation']:  # balance by conservative rating estimate
+				values = [self.ratings[p.id] - self.deviations.get(p.id, 0) for p in self.players]
+			else:
+				values = [self.ratings[p.id] for p in self.players]
+			time_budget = self.cfg['matchmaking_time_budget']
+			# If the workers are busy fall back to the initial heuristic without the local search
+			team = await workers.run(
+				balance_teams, values, team_len, time_budget, timeout=time_budget + 5,
+				fallback=lambda: balance_teams(values, team_len, 0)
 			)
+			best_team = [self.players[i] for i in team]
 			self.teams[0].set(self.sort_players(
 				best_team[:self.cfg['team_size']]
 			))
@@ -232,6 +252,55 @@ class Match:
 			self.teams[1].set([p for p in self.players if p not in self.teams[0]][:self.cfg['team_size']])
 			self.teams[2].set([p for p in self.players if p not in [*self.teams[0], *self.teams[1]]])
 
+	@property
+	def deadline(self):
+		""" Time of the next think() action for the current state """
+		if self.state == self.INIT:
+			return 0
+		elif self.state == self.CHECK_IN:
+			return self.start_time + self.check_in.timeout
+		return self.start_time + self.lifetime
+
+	def schedule(self):
+		scheduler.set(('match', self.id), self.deadline, self._scheduled_think)
+
+	async def _scheduled_think(self, frame_time):
+		if self not in bot.active_matches or self._thinking is not None:
+			return
+
+		# think() is never cancelled as it might be in the middle of a state change, a slow tick is only reported
+		# and the scheduler slot is released, next tick is scheduled once it is done
+		self._thinking = asyncio.create_task(self._think_tick(frame_time))
+		try:
+			await asyncio.wait_for(asyncio.shield(self._thinking), timeout=self.THINK_TIMEOUT)
+		except asyncio.TimeoutError:
+			self.think_stats['overruns'] += 1
+			log.error(f"Match.think() of match {self.id} is running for over {self.THINK_TIMEOUT} seconds.")
+
+	async def _think_tick(self, frame_time):
+		started = perf_counter()
+		try:
+			await self.think(frame_time)
+		except Exception as e:
+			log.error("\n".join([
+				f"Error at Match.think().",
+				f"match_id: {self.id}).",
+				f"{str(e)}. Traceback:\n{traceback.format_exc()}=========="
+			]))
+			if self in bot.active_matches:
+				bot.active_matches.remove(self)
+			return
+		finally:
+			self._thinking = None
+			latency = perf_counter() - started
+			self.think_stats['count'] += 1
+			self.think_stats['total'] += latency
+			self.think_stats['max'] = max(self.think_stats['max'], latency)
+			self.think_stats['last'] = latency
+
+		if self in bot.active_matches:
+			self.schedule()
+
 	async def think(self, frame_time):
 		if self.state == self.INIT:
 			await self.next_state(bot.SystemContext(self.qc))
@@ -239,7 +308,7 @@ class Match:
 		elif self.state == self.CHECK_IN:
 			await self.check_in.think(frame_time)
 
-		elif frame_time > self.lifetime + self.start_time:
+		elif frame_time > self.lifetime + self.start_time and not self.finishing:
 			ctx = bot.SystemContext(self.qc)
 			try:
 				await ctx.error(self.gt("Match {queue} ({id}) has timed out.").format(
@@ -283,6 +352,7 @@ class Match:
 			await self.final_message(ctx)
 
 	async def report_loss(self, ctx, member, draw_flag):
+		self._check_not_finishing()
 		if self.state != self.WAITING_REPORT:
 			raise bot.Exc.MatchStateError(self.gt("The match must be on the waiting report stage."))
 
@@ -316,6 +386,7 @@ class Match:
 		await self.finish_match(ctx)
 
 	async def report_win(self, ctx, team_name, draw=False):  # version for admins/mods
+		self._check_not_finishing()
 		if self.state != self.WAITING_REPORT:
 			raise bot.Exc.MatchStateError(self.gt("The match must be on the waiting report stage."))
 
@@ -330,6 +401,7 @@ class Match:
 		await self.finish_match(ctx)
 
 	async def report_scores(self, ctx, scores):
+		self._check_not_finishing()
 		if self.state != self.WAITING_REPORT:
 			raise bot.Exc.MatchStateError(self.gt("The match must be on the waiting report stage."))
 
@@ -343,13 +415,13 @@ class Match:
 		self.scores = scores
 		await self.finish_match(ctx)
 
-	async def print_rating_results(self, ctx, before, after):
+	async def print_rating_results(self, ctx, before, after, winner):
 		msg = "```markdown\n"
 		msg += f"{self.queue.name.capitalize()}({self.id}) results\n"
 		msg += "-------------"
 
-		if self.winner is not None:
-			winners, losers = self.teams[self.winner], self.teams[abs(self.winner-1)]
+		if winner is not None:
+			winners, losers = self.teams[winner], self.teams[abs(winner-1)]
 		else:
 			winners, losers = self.teams[:2]
 
@@ -378,20 +450,38 @@ class Match:
 		except DiscordException:
 			pass
 
+	def _check_not_finishing(self):
+		if self.finishing:
+			raise bot.Exc.MatchStateError(self.gt("The match is already being registered."))
+
 	async def finish_match(self, ctx):
-		bot.active_matches.remove(self)
+		self._check_not_finishing()
+
+		# Keep the match active until it is registered, so it can be reported again if registration fails
+		self.finishing = True
+		scheduler.cancel(('match', self.id))
+		try:
+			if self.ranked:
+				# The result is fixed here, the ratings and the qc_matches row are computed from the same copy
+				await bot.stats.register_match_ranked(ctx, self, self.winner, tuple(self.scores))
+			else:
+				await bot.stats.register_match_unranked(ctx, self)
+		except Exception:
+			self.schedule()
+			raise
+		finally:
+			self.finishing = False
+
+		if self in bot.active_matches:
+			bot.active_matches.remove(self)
 		self.queue.last_maps += self.maps
 		self.queue.last_maps = self.queue.last_maps[-len(self.maps)*self.queue.cfg.map_cooldown:]
 
-		if self.ranked:
-			await bot.stats.register_match_ranked(ctx, self)
-		else:
-			await bot.stats.register_match_unranked(ctx, self)
-
 	def print(self):
 		return f"> *({self.id})* **{self.queue.name}** | `{join_and([get_nick(p) for p in self.players])}`"
 
 	async def cancel(self, ctx):
+		self._check_not_finishing()
 		if self.check_in.message and self.check_in.message.id in bot.waiting_reactions.keys():
 			bot.waiting_reactions.pop(self.check_in.message.id)
 		try:
@@ -401,3 +491,4 @@ class Match:
 		except DiscordException:
 			pass
 		bot.active_matches.remove(self)
+		scheduler.cancel(('match', self.id))
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
-from time import time
 import re
+import json
 import asyncio
 from enum import Enum
 from nextcord import Forbidden
@@ -9,9 +9,10 @@ from core.cfg_factory import FactoryTable, CfgFactory, Variables, VariableTable
 from core.locales import locales
 from core.utils import join_and, seconds_to_str, get_nick
 from core.database import db
+from core.client import dc
 
 import bot
-from bot.stats.rating import FlatRating, Glicko2Rating, TrueSkillRating
+from bot.stats.rating import FlatRating, Glicko2Rating, TrueSkillRating, cache as rating_cache
 
 MAX_EXPIRE_TIME = 12*60*60
 MAX_PROMOTION_DELAY = 12*60*60
@@ -327,6 +328,18 @@ class QueueChannel:
 
 		return self
 
+	@classmethod
+	async def load(cls, text_channel, qc_row, pq_rows):
+		"""
+		Create QueueChannel object from already fetched qc_configs and pq_configs rows without any db requests.
+		"""
+
+		self = cls(text_channel, await cls.cfg_factory.load(qc_row, text_channel.guild))
+		for row in pq_rows:
+			self.queues.append(bot.PickupQueue(self, await bot.PickupQueue.cfg_factory.load(row, text_channel.guild)))
+
+		return self
+
 	def __init__(self, text_channel, qc_cfg):
 		self.cfg = qc_cfg
 		self.id = text_channel.id
@@ -347,11 +360,15 @@ class QueueChannel:
 		self.last_promote = 0
 
 	async def update_info(self, text_channel):
-		self.cfg.cfg_info['channel_name'] = text_channel.name
-		self.cfg.cfg_info['guild_id'] = text_channel.guild.id
-		self.cfg.cfg_info['guild_name'] = text_channel.guild.name
-
-		await self.cfg.set_info(self.cfg.cfg_info)
+		""" Save channel and guild names to cfg_info if they have changed """
+		info = dict(
+			self.cfg.cfg_info,
+			channel_name=text_channel.name,
+			guild_id=text_channel.guild.id,
+			guild_name=text_channel.guild.name
+		)
+		if info != self.cfg.cfg_info:
+			await self.cfg.set_info(info)
 
 	def update_lang(self):
 		self.gt = locales[self.cfg.lang]
@@ -369,6 +386,22 @@ class QueueChannel:
 			ws_boost=self.cfg.rating_ws_boost,
 			ls_boost=self.cfg.rating_ls_boost
 		)
+		# Ranks of the rating channel are looked up synchronously, load it if it is not loaded yet
+		if self.cfg.rating_channel and self.cfg.rating_channel.id in bot.queue_channel_stubs.keys():
+			asyncio.create_task(bot.get_queue_channel(self.cfg.rating_channel.id))
+
+	@classmethod
+	def stub_decays(cls, channel_id, qc_row):
+		""" Tell if apply_rating_decay() would do anything on a channel not loaded yet, see bot.queue_channel_stubs """
+		data = json.loads(qc_row['cfg_data'])
+		blank = cls.cfg_factory.blank
+		rating_channel = data.get('rating_channel', blank['rating_channel'])
+		if rating_channel and rating_channel != channel_id and dc.get_channel(rating_channel) is not None:
+			return False
+		return bool(
+			data.get('rating_decay', blank['rating_decay']) or
+			data.get('rating_deviation_decay', blank['rating_deviation_decay'])
+		)
 
 	async def apply_rating_decay(self):
 		if self.id == self.rating.channel_id and (self.cfg.rating_decay or self.cfg.rating_deviation_decay):
@@ -459,19 +492,10 @@ class QueueChannel:
 		return below[0]
 
 	async def get_lb(self):
-		now = int(time())
-		data = await db.select(
-			['user_id', 'nick', 'rating', 'deviation', 'wins', 'losses', 'draws', 'streak', 'is_hidden', 'last_ranked_match_at'],
-			'qc_players',
-			where={'channel_id': self.rating.channel_id}, order_by="rating"
+		""" Return the rating channel Leaderboard filtered by this channel settings """
+		return await rating_cache.leaderboard(
+			self.rating.channel_id, self.cfg.lb_min_matches, self.cfg.lb_last_match_limit
 		)
-		return [
-			i for i in data
-			if i['rating'] is not None
-			and not i['is_hidden']
-			and (not self.cfg.lb_last_match_limit or ((i['last_ranked_match_at'] or 0) + self.cfg.lb_last_match_limit > now))
-			and not (self.cfg.lb_min_matches and self.cfg.lb_min_matches > sum((i['wins'], i['losses'], i['draws'])))
-		]
 
 	async def update_rating_roles(self, *members):
 		asyncio.create_task(self._update_rating_roles(*members))
@@ -109,6 +109,14 @@ class PickupQueue:
 				]),
 				notnull=True
 			),
+			Variables.BoolVar(
+				"matchmaking_deviation",
+				display="Matchmaking by deviation",
+				section="Teams",
+				default=0,
+				description="Balance matchmaking teams by rating minus deviation instead of the plain rating.",
+				notnull=True
+			),
 			Variables.OptionVar(
 				"pick_captains",
 				display="Pick captains",
@@ -294,7 +302,7 @@ class PickupQueue:
 
 	@classmethod
 	async def from_json(cls, data):
-		if (qc := bot.queue_channels.get(data['channel_id'])) is None:
+		if (qc := await bot.get_queue_channel(data['channel_id'])) is None:
 			raise bot.Exc.ValueError("QueueChannel not found.")
 		if (q := get(qc.queues, id=data['queue_id'])) is None:
 			raise bot.Exc.ValueError("Queue not found.")
@@ -339,6 +347,7 @@ class PickupQueue:
 			ranked=self.cfg.ranked, pick_captains=self.cfg.pick_captains,
 			captains_role_id=self.cfg.captains_role.id if self.cfg.captains_role else None,
 			pick_teams=self.cfg.pick_teams, pick_order=self.cfg.pick_order,
+			matchmaking_deviation=self.cfg.matchmaking_deviation,
 			maps=[i['name'] for i in self.cfg.maps], vote_maps=self.cfg.vote_maps,
 			map_count=self.cfg.map_count, check_in_timeout=self.cfg.check_in_timeout,
 			check_in_discard=self.cfg.check_in_discard, check_in_discard_immediately=self.cfg.check_in_discard_immediately,
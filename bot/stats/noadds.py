@@ -2,6 +2,7 @@
 import time
 from random import choice
 from core.database import db
+from core.scheduler import scheduler
 from core.utils import get_nick
 
 db.ensure_table(dict(
@@ -14,11 +15,16 @@ db.ensure_table(dict(
 		dict(cname="is_active", ctype=db.types.bool, default=1),
 		dict(cname="at", ctype=db.types.int),
 		dict(cname="duration", ctype=db.types.int),
+		dict(cname="expires_at", ctype=db.types.int),  # at+duration, stored to be indexed
 		dict(cname="reason", ctype=db.types.text),
 		dict(cname="by", ctype=db.types.str),
 		dict(cname="released_by", ctype=db.types.str)
 	],
-	primary_keys=["id"]
+	primary_keys=["id"],
+	indexes=[
+		dict(columns=["guild_id", "user_id", "is_active"]),
+		dict(columns=["is_active", "expires_at"])
+	]
 ))
 
 db.ensure_table(dict(
@@ -33,9 +39,6 @@ db.ensure_table(dict(
 
 class NoAdds:
 
-	def __init__(self):
-		self.next_tick = 0
-
 	@staticmethod
 	async def get_user(ctx, member):
 		""" returns [ban_left, phrase]"""
@@ -59,22 +62,26 @@ class NoAdds:
 		else:
 			await db.delete('qc_phrases', where=dict(channel_id=ctx.channel.id))
 
-	@staticmethod
-	async def noadd(ctx, member, duration, moderator, reason=None):
+	async def noadd(self, ctx, member, duration, moderator, reason=None):
 		await db.update(
 			'noadds',
 			dict(is_active=0, released_by="another noadd"),
 			keys=dict(guild_id=ctx.channel.guild.id, user_id=member.id, is_active=1)
 		)
+		now = int(time.time())
 		await db.insert('noadds', dict(
 			guild_id=ctx.channel.guild.id,
 			user_id=member.id,
 			name=get_nick(member),
-			at=int(time.time()),
+			at=now,
 			duration=duration,
+			expires_at=now + duration,
 			reason=reason,
 			by=get_nick(moderator)
 		))
+		release_at = now + duration
+		if (at := scheduler.get('noadds')) is None or release_at < at:
+			scheduler.set('noadds', release_at, self.release)
 
 	@staticmethod
 	async def forgive(ctx, member, moderator):
@@ -94,10 +101,22 @@ class NoAdds:
 	async def get_noadds(ctx):
 		return await db.select(['*'], 'noadds', where=dict(guild_id=ctx.channel.guild.id, is_active=1))
 
-	async def think(self, frame_time):
-		if frame_time > self.next_tick:
-			await db.execute("UPDATE `noadds` SET is_active=0, released_by='time' WHERE (`at`+`duration`)<%s", (frame_time, ))
-			self.next_tick = frame_time + 60
+	async def schedule_next(self):
+		""" Schedule release of the nearest expiring noadd """
+		# Fill expires_at for noadds created before the column was introduced
+		await db.execute(
+			"UPDATE `noadds` SET `expires_at`=`at`+`duration` WHERE `is_active`=1 AND `expires_at` IS NULL"
+		)
+		row = await db.fetchone("SELECT MIN(`expires_at`) AS release_at FROM `noadds` WHERE `is_active`=1")
+		if row and row['release_at'] is not None:
+			scheduler.set('noadds', row['release_at'], self.release)
+
+	async def release(self, frame_time):
+		await db.execute(
+			"UPDATE `noadds` SET is_active=0, released_by='time' WHERE `is_active`=1 AND `expires_at`<%s",
+			(frame_time, )
+		)
+		await self.schedule_next()
 
 
 noadds = NoAdds()
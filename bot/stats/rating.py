@@ -2,14 +2,378 @@
 import glicko2
 import trueskill
 import time
-
+import asyncio
+import heapq
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from functools import wraps
+
+from core.config import cfg
 from core.database import db
-from core.utils import find, get_nick
+from core.scheduler import scheduler
+from core.workers import workers
+from core.utils import iter_to_dict, get_nick
+from bot.stats.rating_engine import PlayerColumns, replay, decay
 
-from bot.stats import stats
 
+class Leaderboard:
+	""" Players of a channel sorted by rating and filtered by the leaderboard settings, kept up to date by RatingCache """
 
-class BaseRating:
+	def __init__(self, rows, min_matches=None, last_match_limit=None):
+		self.min_matches = min_matches
+		self.last_match_limit = last_match_limit
+		self.rows = dict()  # {user_id: row} of the listed players
+		self.keys = dict()  # {user_id: key} of the listed players
+		self.order = []  # sorted [(-rating, user_id)]
+		self.expire = []  # heap of [(expire_at, user_id)], outdated items are skipped
+
+		now = int(time.time())
+		for row in rows:
+			if self._eligible(row, now):
+				self.rows[row['user_id']] = row
+				self.keys[row['user_id']] = (-row['rating'], row['user_id'])
+				if self.last_match_limit:
+					self.expire.append((self._expire_at(row), row['user_id']))
+		self.order = sorted(self.keys.values())
+		heapq.heapify(self.expire)
+
+	def _expire_at(self, row):
+		return (row['last_ranked_match_at'] or 0) + self.last_match_limit
+
+	def _eligible(self, row, now):
+		return (
+			row['rating'] is not None
+			and not row['is_hidden']
+			and (not self.last_match_limit or self._expire_at(row) > now)
+			and not (self.min_matches and self.min_matches > sum((row['wins'], row['losses'], row['draws'])))
+		)
+
+	def _expire_outdated(self):
+		now = int(time.time())
+		while len(self.expire) and self.expire[0][0] <= now:
+			at, user_id = heapq.heappop(self.expire)
+			if (row := self.rows.get(user_id)) is not None and self._expire_at(row) == at:
+				self.remove(user_id)
+
+	def update(self, row):
+		""" Re-place the player after the row has been changed """
+		self.remove(row['user_id'])
+		if self._eligible(row, int(time.time())):
+			key = (-row['rating'], row['user_id'])
+			self.rows[row['user_id']] = row
+			self.keys[row['user_id']] = key
+			insort(self.order, key)
+			if self.last_match_limit:
+				heapq.heappush(self.expire, (self._expire_at(row), row['user_id']))
+
+	def remove(self, user_id):
+		if (key := self.keys.pop(user_id, None)) is not None:
+			self.rows.pop(user_id)
+			del self.order[bisect_left(self.order, key)]
+
+	def __len__(self):
+		self._expire_outdated()
+		return len(self.order)
+
+	def page(self, start, stop):
+		""" Return copies of the rows on the given places range """
+		self._expire_outdated()
+		return [dict(self.rows[user_id]) for _, user_id in self.order[start:stop]]
+
+	def place(self, user_id):
+		""" Return 1-based place of the player or None if not listed """
+		self._expire_outdated()
+		if (key := self.keys.get(user_id)) is None:
+			return None
+		return bisect_left(self.order, key) + 1
+
+	def get(self, user_id):
+		self._expire_outdated()
+		return dict(row) if (row := self.rows.get(user_id)) is not None else None
+
+
+class RatingCache:
+	"""
+	Write-through cache of qc_players rows grouped by channel_id.
+	Channels are loaded whole for leaderboards, single players are loaded by primary key into partial channels.
+	Least recently used channels are evicted once more than max_rows rows are held,
+	channels not accessed for idle_time seconds are evicted by a scheduled job.
+	"""
+
+	columns = (
+		'user_id', 'nick', 'is_hidden', 'rating', 'deviation', 'wins', 'losses', 'draws', 'streak', 'last_ranked_match_at'
+	)
+	blank = dict(
+		nick=None, is_hidden=0, rating=None, deviation=None, wins=0, losses=0, draws=0, streak=0, last_ranked_match_at=None
+	)
+
+	def __init__(self, max_rows=500000, idle_time=6*60*60):
+		self.max_rows = max_rows
+		self.idle_time = idle_time
+		self.channels = OrderedDict()  # {channel_id: {user_id: row}}, least recently used first
+		self.complete = set()  # {channel_id} of channels holding all of their rows
+		self.accessed = dict()  # {channel_id: last access timestamp}
+		self.leaderboards = dict()  # {channel_id: {(min_matches, last_match_limit): Leaderboard}}
+		self._loading = dict()  # {channel_id: Task}
+		self._patches = dict()  # {channel_id: [function]}, changes made while the channel is being loaded
+		self._versions = dict()  # {channel_id: int}, bumped on every change to detect outdated partial loads
+
+	async def channel(self, channel_id):
+		""" Return {user_id: row} dict of all the channel players, rows must not be modified outside of the cache """
+		if channel_id in self.complete:
+			self._touch(channel_id)
+			return self.channels[channel_id]
+
+		if (task := self._loading.get(channel_id)) is None:
+			task = self._loading[channel_id] = asyncio.create_task(self._load(channel_id))
+		return await asyncio.shield(task)
+
+	async def players(self, channel_id, user_ids):
+		""" Return {user_id: row} dict of the given players, missing players are fetched by primary key """
+		if (task := self._loading.get(channel_id)) is not None:
+			await asyncio.shield(task)
+
+		while channel_id not in self.complete:
+			data = self.channels.get(channel_id, dict())
+			if not len(missing := [user_id for user_id in user_ids if user_id not in data]):
+				break
+			version = self._versions.get(channel_id, 0)
+			rows = await db.fetchall(
+				"SELECT {} FROM `qc_players` WHERE `channel_id`=%s AND `user_id` IN ({})".format(
+					", ".join(f"`{col}`" for col in self.columns), ", ".join(['%s'] * len(missing))
+				),
+				(channel_id, *missing)
+			)
+			if self._versions.get(channel_id, 0) == version:  # otherwise rows might be outdated, fetch again
+				self.channels.setdefault(channel_id, dict()).update(iter_to_dict(rows, key='user_id'))
+				self._evict(keep=channel_id)
+				self._schedule_expire()
+				break
+
+		if (data := self.channels.get(channel_id)) is None:
+			return dict()
+		self._touch(channel_id)
+		return {user_id: data[user_id] for user_id in user_ids if user_id in data}
+
+	async def leaderboard(self, channel_id, min_matches=None, last_match_limit=None):
+		data = await self.channel(channel_id)
+		boards = self.leaderboards.setdefault(channel_id, dict())
+		if (lb := boards.get((min_matches, last_match_limit))) is None:
+			lb = boards[(min_matches, last_match_limit)] = Leaderboard(data.values(), min_matches, last_match_limit)
+		return lb
+
+	async def _load(self, channel_id):
+		self._patches[channel_id] = []
+		try:
+			data = dict()
+			async with db.stream(
+				"SELECT {} FROM `qc_players` WHERE `channel_id`=%s".format(", ".join(f"`{c}`" for c in self.columns)),
+				(channel_id, )
+			) as batches:
+				async for rows in batches:
+					data.update((row['user_id'], row) for row in rows)
+			for patch in self._patches[channel_id]:
+				patch(data)
+			self.channels[channel_id] = data
+			self.complete.add(channel_id)
+			self._touch(channel_id)
+			self._evict(keep=channel_id)
+			self._schedule_expire()
+			return data
+		finally:
+			self._patches.pop(channel_id)
+			self._loading.pop(channel_id)
+
+	def _touch(self, channel_id):
+		self.channels.move_to_end(channel_id)
+		self.accessed[channel_id] = time.time()
+
+	def _forget(self, channel_id):
+		self.channels.pop(channel_id, None)
+		self.complete.discard(channel_id)
+		self.accessed.pop(channel_id, None)
+		self.leaderboards.pop(channel_id, None)
+
+	def _evict(self, keep=None):
+		""" Evict least recently used channels until no more than max_rows rows are held """
+		size = sum(len(data) for data in self.channels.values())
+		for channel_id in list(self.channels.keys()):
+			if size <= self.max_rows:
+				break
+			if channel_id != keep:
+				size -= len(self.channels[channel_id])
+				self._forget(channel_id)
+
+	def _schedule_expire(self):
+		if self.idle_time and len(self.accessed) and scheduler.get('rating_cache') is None:
+			scheduler.set('rating_cache', min(self.accessed.values()) + self.idle_time, self._expire_idle)
+
+	async def _expire_idle(self, frame_time):
+		for channel_id, at in list(self.accessed.items()):
+			if at + self.idle_time <= frame_time:
+				self._forget(channel_id)
+		self._schedule_expire()
+
+	def _apply(self, channel_id, patch, *user_ids, complete_only=False):
+		""" Patch cached rows of the channel, with complete_only partial channels are left as is """
+		self._versions[channel_id] = self._versions.get(channel_id, 0) + 1
+		if channel_id in self._patches:
+			self._patches[channel_id].append(patch)
+		if (data := self.channels.get(channel_id)) is None or (complete_only and channel_id not in self.complete):
+			return
+
+		patch(data)
+		for lb in self.leaderboards.get(channel_id, dict()).values():
+			for user_id in user_ids:
+				if (row := data.get(user_id)) is not None:
+					lb.update(row)
+				else:
+					lb.remove(user_id)
+
+	def insert(self, channel_id, user_id, **fields):
+		""" Add a player row if not exists """
+		def patch(data):
+			if user_id not in data:
+				data[user_id] = dict(self.blank, user_id=user_id, **fields)
+		# The row might exist in the database but not in a partial channel
+		self._apply(channel_id, patch, user_id, complete_only=True)
+
+	def update(self, channel_id, user_id, **fields):
+		def patch(data):
+			if (row := data.get(user_id)) is not None:
+				row.update(fields)
+		self._apply(channel_id, patch, user_id)
+
+	def update_all(self, channel_id, **fields):
+		def patch(data):
+			for row in data.values():
+				row.update(fields)
+		self._apply(channel_id, patch)
+		self.leaderboards.pop(channel_id, None)
+
+	def update_many(self, channel_id, rows):
+		""" Update multiple player rows at once, leaderboards are rebuilt on next access """
+		def patch(data):
+			for fields in rows:
+				if (row := data.get(fields['user_id'])) is not None:
+					row.update(fields)
+		self._apply(channel_id, patch)
+		self.leaderboards.pop(channel_id, None)
+
+	def replace_user(self, channel_id, user_id1, user_id2, **fields):
+		def patch(data):
+			data.pop(user_id2, None)
+			if (row := data.pop(user_id1, None)) is not None:
+				row.update(fields, user_id=user_id2)
+				data[user_id2] = row
+		self._apply(channel_id, patch, user_id1, user_id2)
+
+	def remove(self, channel_id, user_id):
+		self._apply(channel_id, lambda data: data.pop(user_id, None), user_id)
+
+	def drop(self, channel_id):
+		""" Forget the channel, it will be reloaded from the database on next access """
+		self._versions[channel_id] = self._versions.get(channel_id, 0) + 1
+		self._forget(channel_id)
+		if channel_id in self._patches:
+			self._patches[channel_id].append(lambda data: data.clear())
+
+
+rebuilds = dict()  # {channel_id: asyncio.Task} of running BaseRating.rebuild() jobs
+_write_locks = dict()  # {channel_id: asyncio.Lock}, see write_lock()
+cache = RatingCache(
+	max_rows=getattr(cfg, 'RATING_CACHE_ROWS', 500000),
+	idle_time=getattr(cfg, 'RATING_CACHE_IDLE_TIME', 6*60*60)
+)
+
+
+def write_lock(channel_id):
+	"""
+	Lock held by rating writes of the channel for their whole read, compute and write cycle.
+	rebuild() holds it while running, so writes are queued instead of overwriting the rebuilt ratings with stale values.
+	"""
+	if (lock := _write_locks.get(channel_id)) is None:
+		lock = _write_locks[channel_id] = asyncio.Lock()
+	return lock
+
+
+def _locked(method):
+	""" Run a BaseRating coroutine method under the channel write_lock() """
+	@wraps(method)
+	async def wrapper(self, *args, **kwargs):
+		async with write_lock(self.channel_id):
+			return await method(self, *args, **kwargs)
+	return wrapper
+
+
+def rate_rounds(rating_cls, params, team_a, team_b, scores=None):
+	""" Worker process entry point for BaseRating.rate_rounds() """
+	return rating_cls(**params).rate_rounds(team_a, team_b, scores)
+
+
+def _match_scores(m):
+	if m['winner'] is None:
+		return None
+	if m['alpha_score'] or m['beta_score']:
+		return m['alpha_score'] or 0, m['beta_score'] or 0
+	return (1, 0) if m['winner'] == 0 else (0, 1)  # reported before scores were saved
+
+
+def _replay_reference(rating, players, matches):
+	""" Replay matches one by one with rate_rounds(), the reference for the columnar engine """
+	players = dict(players)
+	for m in matches:
+		teams = [[players[user_id] for user_id in team] for team in m['teams']]
+		after = rating.rate_rounds(*teams, scores=_match_scores(m))
+		for p in (*after[0], *after[1]):
+			players[p['user_id']] = dict(players[p['user_id']], **p)
+	return players
+
+
+def replay_matches(rating_cls, params, players, matches, verify=False):
+	"""
+	Worker process entry point for BaseRating.rebuild().
+	Replay matches on the {user_id: player} dict with the columnar engine, return updated players,
+	new qc_rating_history rows and match_ids of the chunk if verify is set and the engine results
+	differ from the reference replay.
+	"""
+	rating = rating_cls(**params)
+	cols = PlayerColumns(players.values())
+	games = [(
+		[cols.index[user_id] for user_id in m['teams'][0]],
+		[cols.index[user_id] for user_id in m['teams'][1]],
+		_match_scores(m)
+	) for m in matches]
+
+	reference = _replay_reference(rating, players, matches) if verify else None
+	players = dict(players)
+	history = []
+	for m, (before, after) in zip(matches, replay(rating, cols, games)):
+		for b, p in zip(before, after):
+			players[p['user_id']] = dict(players[p['user_id']], **p, last_ranked_match_at=m['at'])
+			history.append(dict(
+				channel_id=rating.channel_id,
+				user_id=p['user_id'],
+				at=m['at'],
+				rating_before=b['rating'],
+				rating_change=p['rating']-b['rating'],
+				deviation_before=b['deviation'],
+				deviation_change=p['deviation']-b['deviation'],
+				match_id=m['match_id'],
+				reason=m['queue_name']
+			))
+
+	mismatches = []
+	if reference is not None and any(
+		{k: players[user_id][k] for k in PlayerColumns.columns} != {k: p[k] for k in PlayerColumns.columns}
+		for user_id, p in reference.items()
+	):
+		mismatches = [m['match_id'] for m in matches]
+	return players, history, mismatches
+
+
+class BaseRating(ABC):
 
 	table = "qc_players"
 
@@ -17,6 +381,11 @@ class BaseRating:
 			self, channel_id, init_rp=1500, init_deviation=300, min_deviation=None, scale=100,
 			loss_scale=100, win_scale=100, draw_bonus=0, ws_boost=False, ls_boost=False
 	):
+		self.params = dict(  # constructor arguments to recreate the rating system in a worker process
+			channel_id=channel_id, init_rp=init_rp, init_deviation=init_deviation, min_deviation=min_deviation,
+			scale=scale, loss_scale=loss_scale, win_scale=win_scale, draw_bonus=draw_bonus,
+			ws_boost=ws_boost, ls_boost=ls_boost
+		)
 		self.channel_id = channel_id
 		self.init_rp = init_rp
 		self.init_deviation = init_deviation
@@ -61,15 +430,55 @@ class BaseRating:
 		p['deviation'] = max(self.min_deviation, round(p['deviation'] + d_change))
 		return p
 
+	@abstractmethod
+	def changes(self, winners, losers, draw=False):
+		""" Return [[(r_change, d_change)] for winners, [(r_change, d_change)] for losers] before scaling """
+
+	def rate(self, winners, losers, draw=False):
+		c1, c2 = self.changes(winners, losers, draw)
+		return [
+			[self._scale_changes(p, r, d, 0 if draw else 1) for p, (r, d) in zip(winners, c1)],
+			[self._scale_changes(p, r, d, 0 if draw else -1) for p, (r, d) in zip(losers, c2)]
+		]
+
+	def rate_rounds(self, team_a, team_b, scores=None):
+		"""
+		Rate a match round by round, every won round is rated as a separate game, scores=None rates a draw.
+		Returns [team_a, team_b] player dicts after the last round.
+		"""
+		if scores is None:
+			return self.rate(winners=team_a, losers=team_b, draw=True)
+		return self.rate_series(team_a, team_b, scores[0], scores[1])
+
+	def rate_series(self, winners, losers, wins_a, wins_b):
+		"""
+		Rate wins_a rounds won by winners and wins_b rounds won by losers, rounds won by each side are interleaved.
+		Returns [winners, losers] player dicts after the last round.
+		"""
+		n = 0
+		while n < wins_a or n < wins_b:
+			if n < wins_a:
+				winners, losers = self.rate(winners=winners, losers=losers, draw=False)
+			if n < wins_b:
+				losers, winners = self.rate(winners=losers, losers=winners, draw=False)
+			n += 1
+		return [winners, losers]
+
+	async def rate_match(self, team_a, team_b, scores=None):
+		""" Run rate_rounds() in a worker process """
+		return await workers.run(rate_rounds, type(self), self.params, team_a, team_b, scores)
+
 	async def get_players(self, user_ids):
 		""" Return rating or initial rating for each member """
-		data = await db.select(
-			['user_id', 'rating', 'deviation', 'channel_id', 'wins', 'losses', 'draws', 'streak'], self.table,
-			where={'channel_id': self.channel_id}
-		)
+		user_ids = list(user_ids)
+		data = await cache.players(self.channel_id, user_ids)
 		results = []
 		for user_id in user_ids:
-			if d := find(lambda p: p['user_id'] == user_id, data):
+			if (row := data.get(user_id)) is not None:
+				d = dict(
+					channel_id=self.channel_id, user_id=user_id, rating=row['rating'], deviation=row['deviation'],
+					wins=row['wins'], losses=row['losses'], draws=row['draws'], streak=row['streak']
+				)
 				if d['rating'] is None:
 					d['rating'] = self.init_rp
 					d['deviation'] = self.init_deviation
@@ -78,16 +487,19 @@ class BaseRating:
 			else:
 				d = dict(
 					channel_id=self.channel_id, user_id=user_id, rating=self.init_rp,
-					deviation=self.init_deviation, wins=0, losses=0, draws=0
+					deviation=self.init_deviation, wins=0, losses=0, draws=0, streak=0
 				)
 			results.append(d)
 		return results
 
+	async def get_row(self, user_id):
+		""" Return a copy of the member's qc_players row or None """
+		row = (await cache.players(self.channel_id, [user_id])).get(user_id)
+		return dict(row) if row is not None else None
+
+	@_locked
 	async def set_rating(self, member, rating=None, deviation=None, penality=0, reason=None):
-		old = await db.select_one(
-			('rating', 'deviation'), self.table,
-			where=dict(channel_id=self.channel_id, user_id=member.id)
-		)
+		old = (await cache.players(self.channel_id, [member.id])).get(member.id)
 
 		if not old:
 			rating = max(1, rating - penality if rating else self.init_rp - penality)
@@ -98,16 +510,20 @@ class BaseRating:
 					rating=rating, deviation=deviation or self.init_deviation
 				)
 			)
+			cache.insert(
+				self.channel_id, member.id,
+				nick=get_nick(member), rating=rating, deviation=deviation or self.init_deviation
+			)
 			old = dict(rating=self.init_rp, deviation=self.init_deviation)
 		else:
 			rating = max(1, rating - penality if rating else old['rating'] - penality)
-			old['rating'] = old['rating'] or self.init_rp
-			old['deviation'] = old['deviation'] or self.init_deviation
+			old = dict(rating=old['rating'] or self.init_rp, deviation=old['deviation'] or self.init_deviation)
 			await db.update(
 					self.table,
 					dict(rating=rating, deviation=deviation or old['deviation']),
 					keys=dict(channel_id=self.channel_id, user_id=member.id)
 				)
+			cache.update(self.channel_id, member.id, rating=rating, deviation=deviation or old['deviation'])
 
 		await db.insert(
 			"qc_rating_history",
@@ -121,78 +537,229 @@ class BaseRating:
 
 	async def hide_player(self, user_id, hide=True):
 		await db.update(self.table, dict(is_hidden=hide), keys=dict(channel_id=self.channel_id, user_id=user_id))
+		cache.update(self.channel_id, user_id, is_hidden=hide)
 
+	@_locked
 	async def snap_ratings(self, ranks_table):
-		ranks = [i['rating'] for i in ranks_table if i['rating'] != 0]
+		ranks = sorted(i['rating'] for i in ranks_table if i['rating'] != 0)
 		lowest = min(ranks)
-		data = await db.select(('*',), self.table, where=dict(channel_id=self.channel_id))
-		history = []
 		now = int(time.time())
-		for p in (p for p in data if p['rating'] is not None):
-			new_rating = max([i for i in ranks if i <= p['rating']] + [lowest])
-			history.append(dict(
-				user_id=p['user_id'],
-				channel_id=self.channel_id,
-				at=now,
-				rating_before=p['rating'],
-				rating_change=new_rating - p['rating'],
-				deviation_before=p['deviation'],
-				deviation_change=0,
-				match_id=None,
-				reason="ratings snap"
-			))
-			p['rating'] = new_rating
-		await db.insert_many(self.table, data, on_dublicate='replace')
-		await db.insert_many('qc_rating_history', history)
-
+		changed = False
+		# Changes are written page by page in one transaction while the players are being read
+		async with db.transaction() as conn:
+			async for data in conn.paginate(
+				"SELECT `user_id`, `rating`, `deviation` FROM `qc_players` WHERE `channel_id`=%s AND `rating` IS NOT NULL",
+				(self.channel_id, ), 'user_id'
+			):
+				history = []
+				to_update = []
+				for p in data:
+					i = bisect_right(ranks, p['rating'])
+					new_rating = ranks[i-1] if i else lowest
+					if new_rating == p['rating']:
+						continue
+
+					history.append(dict(
+						user_id=p['user_id'],
+						channel_id=self.channel_id,
+						at=now,
+						rating_before=p['rating'],
+						rating_change=new_rating - p['rating'],
+						deviation_before=p['deviation'],
+						deviation_change=0,
+						match_id=None,
+						reason="ratings snap"
+					))
+					to_update.append(dict(channel_id=self.channel_id, user_id=p['user_id'], rating=new_rating))
+
+				if len(history):
+					await conn.insert_many(self.table, to_update, on_dublicate='update')
+					await conn.insert_many('qc_rating_history', history)
+					changed = True
+
+		if changed:
+			cache.drop(self.channel_id)
+
+	@_locked
 	async def apply_decay(self, rating, deviation, ranks_table):
 		""" Apply weekly rating and deviation decay """
 		now = int(time.time())
-		ranks = [i['rating'] for i in ranks_table if i['rating'] != 0]
-		data = await stats.last_games(self.channel_id)
-		history = []
-		to_update = []
-		for p in data:
-			if None in (p['rating'], p['deviation'], p['at']):
-				continue
-
-			new_deviation = min((self.init_deviation, p['deviation'] + deviation))
-
-			min_rating = max([i for i in ranks if i <= p['rating']]+[0])
-			if min_rating != 0 and p['at'] < (now-(60*60*24*7)):
-				new_rating = max((min_rating, p['rating']-rating))
-			else:
-				new_rating = p['rating']
-
-			if new_rating != p['rating'] or new_deviation != p['deviation']:
-				history.append(dict(
-					user_id=p['user_id'],
-					channel_id=self.channel_id,
-					at=now,
-					rating_before=p['rating'],
-					rating_change=new_rating-p['rating'],
-					deviation_before=p['deviation'],
-					deviation_change=new_deviation-p['deviation'],
-					match_id=None,
-					reason="inactivity rating decay"
-				))
-				p.pop('at')
-				p['deviation'] = new_deviation
-				p['rating'] = new_rating
-				to_update.append(p)
-
-		if len(history):
-			await db.insert_many('qc_rating_history', history)
-			await db.insert_many(self.table, to_update, on_dublicate='replace')
-
+		ranks = sorted(i['rating'] for i in ranks_table if i['rating'] != 0)
+
+		changed = False
+		# Changes are written page by page in one transaction while the players are being read
+		async with db.transaction() as conn:
+			# Fill last_ranked_match_at for players who played before the column was introduced
+			if await conn.fetchone(
+				"SELECT 1 FROM `qc_players` AS p WHERE p.`channel_id`=%s AND p.`rating` IS NOT NULL " +
+				"AND p.`last_ranked_match_at` IS NULL AND EXISTS(" +
+				"  SELECT 1 FROM `qc_rating_history` AS h" +
+				"    WHERE h.`channel_id`=p.`channel_id` AND h.`user_id`=p.`user_id` AND h.`match_id` IS NOT NULL" +
+				") LIMIT 1",
+				(self.channel_id, )
+			):
+				await conn.execute(
+					"UPDATE `qc_players` AS p SET p.`last_ranked_match_at`=(" +
+					"  SELECT MAX(h.`at`) FROM `qc_rating_history` AS h" +
+					"    WHERE h.`channel_id`=p.`channel_id` AND h.`user_id`=p.`user_id` AND h.`match_id` IS NOT NULL" +
+					") WHERE p.`channel_id`=%s AND p.`rating` IS NOT NULL AND p.`last_ranked_match_at` IS NULL",
+					(self.channel_id, )
+				)
+				changed = True  # cached rows hold the old last_ranked_match_at
+
+			async for data in conn.paginate(
+				"SELECT `user_id`, `rating`, `deviation`, `last_ranked_match_at` FROM `qc_players` " +
+				"WHERE `channel_id`=%s AND `rating` IS NOT NULL AND `deviation` IS NOT NULL " +
+				"AND `last_ranked_match_at` IS NOT NULL",
+				(self.channel_id, ), 'user_id'
+			):
+				history = []
+				to_update = []
+				new_ratings, new_deviations = decay(
+					data, ranks, rating, deviation, self.init_deviation, now-(60*60*24*7)
+				)
+				for p, new_rating, new_deviation in zip(data, new_ratings, new_deviations):
+					if new_rating != p['rating'] or new_deviation != p['deviation']:
+						history.append(dict(
+							user_id=p['user_id'],
+							channel_id=self.channel_id,
+							at=now,
+							rating_before=p['rating'],
+							rating_change=new_rating-p['rating'],
+							deviation_before=p['deviation'],
+							deviation_change=new_deviation-p['deviation'],
+							match_id=None,
+							reason="inactivity rating decay"
+						))
+						to_update.append(dict(
+							channel_id=self.channel_id, user_id=p['user_id'], rating=new_rating, deviation=new_deviation
+						))
+
+				if len(history):
+					await conn.insert_many('qc_rating_history', history)
+					await conn.insert_many(self.table, to_update, on_dublicate='update')
+					changed = True
+
+		if changed:
+			cache.drop(self.channel_id)
+
+	async def count_manual_history(self):
+		""" Return the number of qc_rating_history rows not related to matches: seeds, penalties, decay, snaps and resets """
+		return (await db.fetchone(
+			"SELECT COUNT(*) AS `count` FROM `qc_rating_history` WHERE `channel_id`=%s AND `match_id` IS NULL",
+			(self.channel_id, )
+		))['count']
+
+	async def rebuild(self, progress=None, dry_run=False, discard_history=False, chunk_size=200):
+		"""
+		Recalculate players ratings and stats by replaying the ranked matches in match_id order with current settings.
+		Matches are read page by page and replayed in a worker process, the new history of each page is written
+		right away. Everything is written in one transaction, the channel qc_players and qc_rating_history rows are
+		locked with SELECT ... FOR UPDATE until it commits and rating writes of the bot wait on write_lock().
+		Non-match history (seeds, penalties, decay) is discarded, this requires discard_history=True if there is any.
+		A dry run writes nothing and checks the replay against the reference rate_rounds() replay.
+		Progress is reported by await progress(done, total) after each chunk of matches.
+		Returns ({user_id: (rating before, rating after)}, [mismatching match_id]) or None if non-match history
+		would be discarded without discard_history.
+		"""
+		if dry_run:
+			return await self._rebuild(progress, dry_run, discard_history, chunk_size)
+		async with write_lock(self.channel_id):
+			return await self._rebuild(progress, dry_run, discard_history, chunk_size)
+
+	async def _rebuild(self, progress, dry_run, discard_history, chunk_size):
+		async with (db.connection() if dry_run else db.transaction()) as conn:
+			before = {row['user_id']: row['rating'] for row in await conn.fetchall(
+				"SELECT `user_id`, `rating` FROM `qc_players` WHERE `channel_id`=%s" + ("" if dry_run else " FOR UPDATE"),
+				(self.channel_id, )
+			)}
+			old_history = await conn.fetchone(
+				"SELECT MAX(`id`) AS `last_id`, COALESCE(SUM(`match_id` IS NULL), 0) AS `manual` " +
+				"FROM `qc_rating_history` WHERE `channel_id`=%s" + ("" if dry_run else " FOR UPDATE"),
+				(self.channel_id, )
+			)
+			if old_history['manual'] and not dry_run and not discard_history:
+				return None
+
+			# New history is written next to the old one, matches are selected by the old rows which are deleted last
+			args = (self.channel_id, old_history['last_id'] or 0)
+			total = (await conn.fetchone(
+				"SELECT COUNT(DISTINCT `match_id`) AS `count` FROM `qc_rating_history` " +
+				"WHERE `channel_id`=%s AND `match_id` IS NOT NULL AND `id`<=%s",
+				args
+			))['count']
+
+			players = dict()
+			mismatches = []
+			done = 0
+			async for chunk in conn.paginate(
+				"SELECT m.`match_id`, m.`queue_name`, m.`at`, m.`winner`, m.`alpha_score`, m.`beta_score` " +
+				"FROM `qc_matches` AS m WHERE m.`ranked`=1 AND EXISTS (" +
+				"  SELECT 1 FROM `qc_rating_history` AS h" +
+				"    WHERE h.`match_id`=m.`match_id` AND h.`channel_id`=%s AND h.`id`<=%s" +
+				")",
+				args, 'match_id', column="m.`match_id`", batch_size=chunk_size
+			):
+				teams = dict()
+				for row in await conn.fetchall(
+					"SELECT `match_id`, `user_id`, `team` FROM `qc_player_matches` " +
+					"WHERE `match_id` IN ({}) AND `team` IS NOT NULL".format(", ".join(["%s"] * len(chunk))),
+					[m['match_id'] for m in chunk]
+				):
+					teams.setdefault(row['match_id'], ([], []))[row['team']].append(row['user_id'])
+
+				done += len(chunk)
+				chunk = [dict(m, teams=teams[m['match_id']]) for m in chunk if all(teams.get(m['match_id'], ([], )))]
+				involved = dict()
+				for m in chunk:
+					for user_id in (*m['teams'][0], *m['teams'][1]):
+						involved[user_id] = players.get(user_id) or dict(
+							user_id=user_id, rating=self.init_rp, deviation=self.init_deviation,
+							wins=0, losses=0, draws=0, streak=0, last_ranked_match_at=None
+						)
+				if len(chunk):
+					involved, history, chunk_mismatches = await workers.run(
+						replay_matches, type(self), self.params, involved, chunk, dry_run, timeout=60
+					)
+					players.update(involved)
+					mismatches += chunk_mismatches
+					if not dry_run:
+						await conn.insert_many('qc_rating_history', history)
+				if progress:
+					await progress(done, total)
+
+			if not dry_run:
+				await conn.execute(
+					"DELETE FROM `qc_rating_history` WHERE `channel_id`=%s AND `id`<=%s", args
+				)
+				await conn.execute(
+					"UPDATE `qc_players` SET `rating`=NULL, `deviation`=NULL, `wins`=0, `losses`=0, `draws`=0, `streak`=0, " +
+					"`last_ranked_match_at`=NULL WHERE `channel_id`=%s",
+					(self.channel_id, )
+				)
+				rows = [dict(p, channel_id=self.channel_id) for p in players.values()]
+				for i in range(0, len(rows), 5000):
+					await conn.insert_many(self.table, rows[i:i+5000], on_dublicate='update')
+
+		if not dry_run:
+			cache.drop(self.channel_id)
+		changes = {
+			user_id: (rating, players[user_id]['rating'] if user_id in players else None)
+			for user_id, rating in before.items() if rating is not None or user_id in players
+		}
+		return changes, mismatches
+
+	@_locked
 	async def reset(self):
-		data = await db.select(('user_id', 'rating', 'deviation'), self.table, where=dict(channel_id=self.channel_id))
-		history = []
 		now = int(time.time())
 
-		for p in data:
-			if p['rating'] is not None and (p['rating'] != self.init_rp or p['deviation'] != self.init_deviation):
-				history.append(dict(
+		# History is written page by page in one transaction while the players are being read
+		async with db.transaction() as conn:
+			async for data in conn.paginate(
+				"SELECT `user_id`, `rating`, `deviation` FROM `qc_players` WHERE `channel_id`=%s AND `rating` IS NOT NULL",
+				(self.channel_id, ), 'user_id'
+			):
+				await conn.insert_many('qc_rating_history', [dict(
 					user_id=p['user_id'],
 					channel_id=self.channel_id,
 					at=now,
@@ -202,13 +769,13 @@ class BaseRating:
 					deviation_change=self.init_deviation-p['deviation'],
 					match_id=None,
 					reason="ratings reset"
-				))
+				) for p in data if p['rating'] != self.init_rp or p['deviation'] != self.init_deviation])
 
-		await db.update(
-			self.table, dict(rating=None, deviation=None), keys=dict(channel_id=self.channel_id)
-		)
-		if len(history):
-			await db.insert_many('qc_rating_history', history)
+			await conn.execute(
+				"UPDATE `qc_players` SET `rating`=NULL, `deviation`=NULL WHERE `channel_id`=%s AND `rating` IS NOT NULL",
+				(self.channel_id, )
+			)
+		cache.update_all(self.channel_id, rating=None, deviation=None)
 
 
 class FlatRating(BaseRating):
@@ -219,21 +786,65 @@ class FlatRating(BaseRating):
 	def _scale_draw(self, r_change):
 		return 10 * self.draw_bonus
 
-	def rate(self, winners, losers, draw=False):
-		r1, r2 = [], []
-		if not draw:
-			for p in winners:
-				new = self._scale_changes(p, 10, 0, 1)
-				r1.append(new)
-
-			for p in losers:
-				new = self._scale_changes(p, -10, 0, -1)
-				r2.append(new)
-		else:
-			r1 = [self._scale_changes(p, 0, 0, 0) for p in winners]
-			r2 = [self._scale_changes(p, 0, 0, 0) for p in losers]
+	def changes(self, winners, losers, draw=False):
+		if draw:
+			return [[(0, 0)] * len(winners), [(0, 0)] * len(losers)]
+		return [[(10, 0)] * len(winners), [(-10, 0)] * len(losers)]
+
+	def rate_series(self, winners, losers, wins_a, wins_b):
+		"""
+		Flat rating changes do not depend on the opponents, so each player replays own sequence of results:
+		interleaved win/loss pairs followed by the remaining wins or losses. Same result as BaseRating.rate_series().
+		"""
+		pairs, tail = min(wins_a, wins_b), abs(wins_a - wins_b)
+		tail_a = 1 if wins_a > wins_b else -1
+		return [
+			[self._replay(self._replay(p, (1, -1), pairs), (tail_a, ), tail) for p in winners],
+			[self._replay(self._replay(p, (-1, 1), pairs), (-tail_a, ), tail) for p in losers]
+		]
 
-		return [r1, r2]
+	def _boost(self, streak):
+		""" Streak boost multiplier class for the next result, see BaseRating._scale_changes() """
+		if (self.ws_boost and streak >= 2) or (self.ls_boost and streak <= -2):
+			return min(abs(streak) + 1, 6) * (1 if streak > 0 else -1)
+		return 0
+
+	def _replay(self, p, cycle, count):
+		"""
+		Apply the cycle of scores count times. Once two cycles in a row change the player the same way
+		(same boost class, no rating floor hit), the rest of the cycles are applied at once.
+		"""
+		prev_steps = None
+		while count > 0:
+			before, steps = p, []
+			for score in cycle:
+				new = self._scale_changes(p, 10 * score, 0, score)
+				steps.append(new['rating'] - p['rating'])
+				p = new
+			count -= 1
+
+			if steps != prev_steps or self._boost(before['streak']) != self._boost(p['streak']):
+				prev_steps = steps
+				continue
+
+			delta = sum(steps)
+			if p['rating'] == 0 or 0 in (before['rating'] + sum(steps[:i+1]) for i in range(len(steps))):
+				# The floor might be hit, skip only if the rating is back where the cycle started
+				jump = count if delta == 0 else 0
+			elif delta >= 0:
+				jump = count
+			else:  # keep all the skipped cycles above the floor
+				lowest = min(sum(steps[:i+1]) for i in range(len(steps)))
+				jump = min(count, max(0, (p['rating'] + lowest) // -delta))
+
+			if jump:
+				p = p.copy()
+				p['rating'] += delta * jump
+				p['streak'] += (p['streak'] - before['streak']) * jump
+				p['wins'] += cycle.count(1) * jump
+				p['losses'] += cycle.count(-1) * jump
+				count -= jump
+		return p
 
 
 class Glicko2Rating(BaseRating):
@@ -241,7 +852,7 @@ class Glicko2Rating(BaseRating):
 	def __init__(self, **kwargs):
 		super().__init__(**kwargs)
 
-	def rate(self, winners, losers, draw=False):
+	def changes(self, winners, losers, draw=False):
 		score_w = 0.5 if draw else 1
 		score_l = 0.5 if draw else 0
 		r1, r2 = [], []
@@ -264,15 +875,13 @@ class Glicko2Rating(BaseRating):
 			po.setRating(avg_w[0][0])
 			po.setRd(p['deviation'])
 			po.update_player(*avg_l)
-			new = self._scale_changes(p, po.getRating() - avg_w[0][0], po.getRd() - p['deviation'], 0 if draw else 1)
-			r1.append(new)
+			r1.append((po.getRating() - avg_w[0][0], po.getRd() - p['deviation']))
 
 		for p in losers:
 			po.setRating(avg_l[0][0])
 			po.setRd(p['deviation'])
 			po.update_player(*avg_w)
-			new = self._scale_changes(p, po.getRating() - avg_l[0][0], po.getRd() - p['deviation'], 0 if draw else -1)
-			r2.append(new)
+			r2.append((po.getRating() - avg_l[0][0], po.getRd() - p['deviation']))
 
 		return [r1, r2]
 
@@ -286,22 +895,14 @@ class TrueSkillRating(BaseRating):
 			beta=int(self.init_deviation/2), tau=int(self.init_deviation/100)
 		)
 
-	def rate(self, winners, losers, draw=False):
+	def changes(self, winners, losers, draw=False):
 		g1 = [self.ts.create_rating(mu=p['rating'], sigma=p['deviation']) for p in winners]
 		g2 = [self.ts.create_rating(mu=p['rating'], sigma=p['deviation']) for p in losers]
-		r1, r2 = [], []
 
 		ranks = [0, 0] if draw else [0, 1]
-		g1, g2 = (list(i) for i in self.ts.rate((g1, g2), ranks=ranks))
-
-		for p in winners:
-			res = g1.pop(0)
-			new = self._scale_changes(p, res.mu - p['rating'], res.sigma - p['deviation'], 0 if draw else 1)
-			r1.append(new)
+		g1, g2 = self.ts.rate((g1, g2), ranks=ranks)
 
-		for p in losers:
-			res = g2.pop(0)
-			new = self._scale_changes(p, res.mu - p['rating'], res.sigma - p['deviation'], 0 if draw else -1)
-			r2.append(new)
-
-		return [r1, r2]
+		return [
+			[(res.mu - p['rating'], res.sigma - p['deviation']) for p, res in zip(winners, g1)],
+			[(res.mu - p['rating'], res.sigma - p['deviation']) for p, res in zip(losers, g2)]
+		]
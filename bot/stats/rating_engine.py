@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_right
+
+from core.console import log
+
+try:
+	import numpy
+except ModuleNotFoundError:  # numpy is optional, lists are used without it
+	numpy = None
+
+_parity = dict()  # {key: bool}, results of the numpy code paths parity checks
+
+
+def _use_numpy(key, check):
+	"""
+	Return True if the numpy code path can be used. The first time a key is seen check() compares the numpy path
+	with the plain python one on real data, the numpy path is disabled for the key if the results differ.
+	"""
+	if numpy is None:
+		return False
+	if (ok := _parity.get(key)) is None:
+		ok = _parity[key] = check()
+		if not ok:
+			log.error(f"Rating engine numpy results differ from the reference for {key}, falling back to python.")
+	return ok
+
+
+class PlayerColumns:
+	"""
+	Columnar player stats for bulk rating calculations.
+	Every column is a numpy int64 array if numpy is installed or a list otherwise.
+	"""
+
+	columns = ('rating', 'deviation', 'wins', 'losses', 'draws', 'streak')
+
+	def __init__(self, rows, use_numpy=True):
+		rows = list(rows)
+		self.user_ids = [row['user_id'] for row in rows]
+		self.index = {user_id: i for i, user_id in enumerate(self.user_ids)}  # {user_id: row number}
+		for col in self.columns:
+			values = [row[col] for row in rows]
+			setattr(self, col, numpy.array(values, dtype=numpy.int64) if numpy and use_numpy else values)
+
+	def __len__(self):
+		return len(self.user_ids)
+
+	def rows(self, idx=None):
+		""" Return player dicts of the given row numbers or all of them """
+		idx = range(len(self)) if idx is None else idx
+		return [dict(
+			user_id=self.user_ids[i], **{col: int(getattr(self, col)[i]) for col in self.columns}
+		) for i in idx]
+
+	def set_row(self, i, p):
+		for col in self.columns:
+			getattr(self, col)[i] = p[col]
+
+
+def _scale_changes_python(rating, cols, idx, r_change, d_change, score):
+	for i, r, d, s in zip(idx, r_change, d_change, score):
+		cols.set_row(i, rating._scale_changes(cols.rows((i, ))[0], r, d, s))
+
+
+def _scale_changes_numpy(rating, cols, idx, r_change, d_change, score):
+	idx = numpy.asarray(idx, dtype=numpy.int64)
+	r_change = numpy.asarray(r_change, dtype=numpy.float64)
+	d_change = numpy.asarray(d_change, dtype=numpy.float64)
+	score = numpy.asarray(score)
+	win, draw, loss = score == 1, score == 0, score == -1
+	streak = cols.streak[idx]
+
+	streak = numpy.where(loss, numpy.where(streak >= 0, -1, streak - 1), streak)
+	streak = numpy.where(draw, 0, streak)
+	streak = numpy.where(win, numpy.where(streak <= 0, 1, streak + 1), streak)
+
+	# Same operations order as in _scale_changes() so floats round the same way
+	r_new = r_change.copy()
+	r_new[loss] = rating._scale_loss(r_change[loss]) * rating.scale
+	r_new[draw] = rating._scale_draw(r_change[draw]) * rating.scale
+	r_new[win] = rating._scale_win(r_change[win]) * rating.scale
+	boost = numpy.minimum(numpy.abs(streak), 6) / 2
+	if rating.ls_boost:
+		r_new = numpy.where(loss & (streak < -2), r_new * boost, r_new)
+	if rating.ws_boost:
+		r_new = numpy.where(win & (streak > 2), r_new * boost, r_new)
+
+	cols.rating[idx] = numpy.maximum(0, numpy.round(cols.rating[idx] + r_new))
+	cols.deviation[idx] = numpy.maximum(rating.min_deviation, numpy.round(cols.deviation[idx] + d_change))
+	cols.wins[idx] += win
+	cols.losses[idx] += loss
+	cols.draws[idx] += draw
+	cols.streak[idx] = streak
+
+
+def scale_changes(rating, cols, idx, r_change, d_change, score):
+	"""
+	Vectorized BaseRating._scale_changes(): apply raw rating changes to the players on rows idx in place.
+	r_change, d_change and score are sequences aligned with idx, score is 1 for a win, 0 for a draw, -1 for a loss.
+	Gives exactly the same integer results as calling rating._scale_changes() for each player.
+	"""
+	if not isinstance(cols.rating, list):
+		def check():
+			a, b = PlayerColumns(cols.rows()), PlayerColumns(cols.rows(), use_numpy=False)
+			_scale_changes_numpy(rating, a, idx, r_change, d_change, score)
+			_scale_changes_python(rating, b, idx, r_change, d_change, score)
+			return a.rows(idx) == b.rows(idx)
+
+		settings = tuple((k, v) for k, v in sorted(rating.params.items()) if k != 'channel_id')
+		if _use_numpy(('scale_changes', type(rating).__name__, settings), check):
+			return _scale_changes_numpy(rating, cols, idx, r_change, d_change, score)
+	_scale_changes_python(rating, cols, idx, r_change, d_change, score)
+
+
+def rate_matches(rating, cols, matches):
+	"""
+	Rate single game matches on the columns in place. Every match is a (winners, losers, draw) tuple of row number lists.
+	Raw changes are computed by rating.changes() match by match, scaling is applied to all matches at once
+	so the matches in one call must not share players.
+	"""
+	idx, r_change, d_change, score = [], [], [], []
+	for winners, losers, draw in matches:
+		c1, c2 = rating.changes(cols.rows(winners), cols.rows(losers), draw)
+		for team, changes, s in ((winners, c1, 0 if draw else 1), (losers, c2, 0 if draw else -1)):
+			idx.extend(team)
+			r_change.extend(r for r, d in changes)
+			d_change.extend(d for r, d in changes)
+			score.extend([s] * len(team))
+	if len(idx):
+		scale_changes(rating, cols, idx, r_change, d_change, score)
+
+
+def replay(rating, cols, matches):
+	"""
+	Replay matches in order on the columns in place, same results as rating.rate_rounds() for each match.
+	Every match is a (team_a, team_b, scores) tuple of row number lists and (score_a, score_b) or None for a draw.
+	Consecutive matches without common players are rated at once. Returns [(before, after)] player dicts lists.
+	"""
+	results = []
+	wave, busy = [], set()
+
+	def flush():
+		before = [cols.rows((*a, *b)) for a, b, scores in wave]
+		games = []
+		for a, b, scores in wave:
+			if scores is None:
+				games.append((a, b, True))
+			elif sum(scores) == 1:  # a single round, same as rate_series() of one round
+				games.append((a, b, False) if scores[0] else (b, a, False))
+			else:
+				after = rating.rate_series(cols.rows(a), cols.rows(b), *scores)
+				for i, p in zip((*a, *b), (*after[0], *after[1])):
+					cols.set_row(i, p)
+		rate_matches(rating, cols, games)
+		results.extend(zip(before, (cols.rows((*a, *b)) for a, b, scores in wave)))
+		wave.clear()
+		busy.clear()
+
+	for a, b, scores in matches:
+		if not busy.isdisjoint(a) or not busy.isdisjoint(b):
+			flush()
+		wave.append((a, b, scores))
+		busy.update(a, b)
+	flush()
+	return results
+
+
+def _decay_python(rows, ranks, rating, deviation, max_deviation, inactive_before):
+	new_ratings, new_deviations = [], []
+	for p in rows:
+		i = bisect_right(ranks, p['rating'])
+		min_rating = max(ranks[i-1], 0) if i else 0
+		if min_rating != 0 and p['last_ranked_match_at'] < inactive_before:
+			new_ratings.append(max((min_rating, p['rating']-rating)))
+		else:
+			new_ratings.append(p['rating'])
+		new_deviations.append(min((max_deviation, p['deviation'] + deviation)))
+	return new_ratings, new_deviations
+
+
+def _decay_numpy(rows, ranks, rating, deviation, max_deviation, inactive_before):
+	r = numpy.array([p['rating'] for p in rows], dtype=numpy.int64)
+	d = numpy.array([p['deviation'] for p in rows], dtype=numpy.int64)
+	last = numpy.array([p['last_ranked_match_at'] for p in rows], dtype=numpy.int64)
+	ranks = numpy.array(ranks or [0], dtype=numpy.int64)
+
+	i = numpy.searchsorted(ranks, r, side='right')
+	min_rating = numpy.where(i > 0, numpy.maximum(ranks[numpy.maximum(i - 1, 0)], 0), 0)
+	inactive = (min_rating != 0) & (last < inactive_before)
+	new_r = numpy.where(inactive, numpy.maximum(min_rating, r - rating), r)
+	new_d = numpy.minimum(max_deviation, d + deviation)
+	return new_r.tolist(), new_d.tolist()
+
+
+def decay(rows, ranks, rating, deviation, max_deviation, inactive_before):
+	"""
+	Weekly decay of qc_players rows, see BaseRating.apply_decay(). ranks is a sorted list of the rank ratings.
+	Returns (new ratings, new deviations) lists aligned with rows.
+	"""
+	rows = list(rows)
+	if len(rows) and _use_numpy(
+		('decay', tuple(ranks), rating, deviation, max_deviation),
+		lambda: _decay_numpy(rows, ranks, rating, deviation, max_deviation, inactive_before) ==
+		_decay_python(rows, ranks, rating, deviation, max_deviation, inactive_before)
+	):
+		return _decay_numpy(rows, ranks, rating, deviation, max_deviation, inactive_before)
+	return _decay_python(rows, ranks, rating, deviation, max_deviation, inactive_before)
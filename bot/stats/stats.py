@@ -5,7 +5,9 @@ import asyncio
 import bot
 from core.console import log
 from core.database import db
+from core.scheduler import scheduler
 from core.utils import iter_to_dict, find, get_nick
+from bot.stats import rating
 
 db.ensure_table(dict(
 	tname="players",
@@ -33,7 +35,10 @@ db.ensure_table(dict(
 		dict(cname="streak", ctype=db.types.int, notnull=True, default=0),
 		dict(cname="last_ranked_match_at", ctype=db.types.int, notnull=False)
 	],
-	primary_keys=["user_id", "channel_id"]
+	primary_keys=["user_id", "channel_id"],
+	indexes=[
+		dict(columns=["channel_id"])  # keeps rating rebuild row locks within the channel
+	]
 ))
 
 db.ensure_table(dict(
@@ -50,7 +55,12 @@ db.ensure_table(dict(
 		dict(cname="match_id", ctype=db.types.int),
 		dict(cname="reason", ctype=db.types.str)
 	],
-	primary_keys=["id"]
+	primary_keys=["id"],
+	indexes=[
+		dict(columns=["match_id"]),
+		dict(columns=["channel_id", "user_id"]),
+		dict(columns=["channel_id", "match_id"])
+	]
 ))
 
 db.ensure_table(dict(
@@ -88,7 +98,10 @@ db.ensure_table(dict(
 		dict(cname="nick", ctype=db.types.str),
 		dict(cname="team", ctype=db.types.bool)
 	],
-	primary_keys=["match_id", "user_id"]
+	primary_keys=["match_id", "user_id"],
+	indexes=[
+		dict(columns=["channel_id", "user_id"])
+	]
 ))
 
 db.ensure_table(dict(
@@ -113,122 +126,161 @@ async def check_match_id_counter():
 		await db.update('qc_match_id_counter', dict(next_id=next_known_match))
 
 
-async def next_match():
-	""" Increase match_id counter, return current match_id """
-	counter = await db.select_one(('next_id',), 'qc_match_id_counter')
-	await db.update('qc_match_id_counter', dict(next_id=counter['next_id']+1))
-	log.debug(f"Current match_id is {counter['next_id']}")
-	return counter['next_id']
+class MatchIdAllocator:
+	""" Reserves match ids from qc_match_id_counter in blocks and hands them out from memory """
 
+	def __init__(self, block_size=10):
+		self.block_size = block_size
+		self.next_id = None
+		self.end_id = None  # first id after the reserved block
+		self.lock = asyncio.Lock()
 
-async def register_match_unranked(ctx, m):
-	await db.insert('qc_matches', dict(
-		match_id=m.id, channel_id=m.qc.id, queue_id=m.queue.cfg.p_key, queue_name=m.queue.name,
-		alpha_name=m.teams[0].name, beta_name=m.teams[1].name,
-		at=int(time.time()), ranked=0, winner=None, maps="\n".join(m.maps)
-	))
+	async def next(self):
+		async with self.lock:
+			if self.next_id is None or self.next_id >= self.end_id:
+				# LAST_INSERT_ID(expr) makes the increment and the read a single atomic statement
+				self.end_id = await db.execute(
+					"UPDATE `qc_match_id_counter` SET `next_id`=LAST_INSERT_ID(`next_id`+%s)", (self.block_size, )
+				)
+				self.next_id = self.end_id - self.block_size
+				log.debug(f"Reserved match ids {self.next_id}-{self.end_id-1}")
+			match_id = self.next_id
+			self.next_id += 1
+		return match_id
 
-	await db.insert_many('qc_players', (
-		dict(channel_id=m.qc.id, user_id=p.id)
-		for p in m.players
-	), on_dublicate="ignore")
+	async def release(self):
+		""" Return unused ids of the current block, they are just skipped if the counter has moved on """
+		async with self.lock:
+			if self.next_id is not None and self.next_id < self.end_id:
+				await db.execute(
+					"UPDATE `qc_match_id_counter` SET `next_id`=%s WHERE `next_id`=%s", (self.next_id, self.end_id)
+				)
+			self.next_id = self.end_id = None
 
-	for p in m.players:
-		nick = get_nick(p)
-		await db.update(
-			"qc_players",
-			dict(nick=nick),
-			keys=dict(channel_id=m.qc.id, user_id=p.id)
-		)
-
-		if p in m.teams[0]:
-			team = 0
-		elif p in m.teams[1]:
-			team = 1
-		else:
-			team = None
-
-		await db.insert(
-			'qc_player_matches',
-			dict(match_id=m.id, channel_id=m.qc.id, user_id=p.id, nick=nick, team=team)
-		)
-
-
-async def register_match_ranked(ctx, m):
-	now = int(time.time())
 
-	await db.insert('qc_matches', dict(
-		match_id=m.id, channel_id=m.qc.id, queue_id=m.queue.cfg.p_key, queue_name=m.queue.name,
-		alpha_name=m.teams[0].name, beta_name=m.teams[1].name,
-		at=now, ranked=1, winner=m.winner,
-		alpha_score=m.scores[0], beta_score=m.scores[1], maps="\n".join(m.maps)
-	))
+match_ids = MatchIdAllocator()
+
+
+async def next_match():
+	""" Return next free match_id """
+	match_id = await match_ids.next()
+	log.debug(f"Current match_id is {match_id}")
+	return match_id
 
-	for channel_id in {m.qc.id, m.qc.rating.channel_id}:
-		await db.insert_many('qc_players', (
-			dict(channel_id=channel_id, user_id=p.id, nick=get_nick(p))
+
+async def register_match_unranked(ctx, m):
+	# A single transaction, so a failed registration leaves nothing behind and the match can be reported again
+	async with db.transaction() as conn:
+		await conn.insert('qc_matches', dict(
+			match_id=m.id, channel_id=m.qc.id, queue_id=m.queue.cfg.p_key, queue_name=m.queue.name,
+			alpha_name=m.teams[0].name, beta_name=m.teams[1].name,
+			at=int(time.time()), ranked=0, winner=None, maps="\n".join(m.maps)
+		))
+
+		await conn.insert_many('qc_players', (
+			dict(channel_id=m.qc.id, user_id=p.id)
 			for p in m.players
 		), on_dublicate="ignore")
 
-	results = [[
-		await m.qc.rating.get_players((p.id for p in m.teams[0])),
-		await m.qc.rating.get_players((p.id for p in m.teams[1])),
-	]]
-
-	if m.winner is None:  # draw
-		after = m.qc.rating.rate(winners=results[0][0], losers=results[0][1], draw=True)
-		results.append(after)
-	else:  # process actual scores
-		n = 0
-		while n < m.scores[0] or n < m.scores[1]:
-			if n < m.scores[0]:
-				after = m.qc.rating.rate(winners=results[-1][0], losers=results[-1][1], draw=False)
-				results.append(after)
-			if n < m.scores[1]:
-				after = m.qc.rating.rate(winners=results[-1][1], losers=results[-1][0], draw=False)
-				results.append(after[::-1])
-			n += 1
-
-	after = iter_to_dict((*results[-1][0], *results[-1][1]), key='user_id')
-	before = iter_to_dict((*results[0][0], *results[0][1]), key='user_id')
+		for p in m.players:
+			await conn.update(
+				"qc_players",
+				dict(nick=get_nick(p)),
+				keys=dict(channel_id=m.qc.id, user_id=p.id)
+			)
+
+			if p in m.teams[0]:
+				team = 0
+			elif p in m.teams[1]:
+				team = 1
+			else:
+				team = None
+
+			await conn.insert(
+				'qc_player_matches',
+				dict(match_id=m.id, channel_id=m.qc.id, user_id=p.id, nick=get_nick(p), team=team)
+			)
 
 	for p in m.players:
-		nick = get_nick(p)
-		team = 0 if p in m.teams[0] else 1
-
-		await db.update(
-			"qc_players",
-			dict(
-				nick=nick,
-				rating=after[p.id]['rating'],
-				deviation=after[p.id]['deviation'],
-				wins=after[p.id]['wins'],
-				losses=after[p.id]['losses'],
-				draws=after[p.id]['draws'],
-				streak=after[p.id]['streak'],
-				last_ranked_match_at=now,
-			),
-			keys=dict(channel_id=m.qc.rating.channel_id, user_id=p.id)
-		)
-
-		await db.insert(
-			'qc_player_matches',
-			dict(match_id=m.id, channel_id=m.qc.id, user_id=p.id, nick=nick, team=team)
-		)
-		await db.insert('qc_rating_history', dict(
+		rating.cache.insert(m.qc.id, p.id, nick=get_nick(p))
+		rating.cache.update(m.qc.id, p.id, nick=get_nick(p))
+
+
+async def register_match_ranked(ctx, m, winner, scores):
+	now = int(time.time())
+
+	if m.qc.rating.channel_id in rating.rebuilds:
+		await ctx.notice(m.gt("Ratings are being rebuilt, the match will be registered once it is done."))
+	# Ratings are computed from the current rows, no other rating write may run in between
+	async with rating.write_lock(m.qc.rating.channel_id):
+		before = [
+			await m.qc.rating.get_players((p.id for p in m.teams[0])),
+			await m.qc.rating.get_players((p.id for p in m.teams[1])),
+		]
+		after = await m.qc.rating.rate_match(*before, scores=None if winner is None else scores)
+
+		after = iter_to_dict((*after[0], *after[1]), key='user_id')
+		before = iter_to_dict((*before[0], *before[1]), key='user_id')
+
+		nicks = {p.id: get_nick(p) for p in m.players}
+		players = [dict(
 			channel_id=m.qc.rating.channel_id,
 			user_id=p.id,
-			at=now,
-			rating_before=before[p.id]['rating'],
-			rating_change=after[p.id]['rating']-before[p.id]['rating'],
-			deviation_before=before[p.id]['deviation'],
-			deviation_change=after[p.id]['deviation']-before[p.id]['deviation'],
-			match_id=m.id,
-			reason=m.queue.name
-		))
-
-	await m.qc.update_rating_roles(*m.players)
-	await m.print_rating_results(ctx, before, after)
+			nick=nicks[p.id],
+			rating=after[p.id]['rating'],
+			deviation=after[p.id]['deviation'],
+			wins=after[p.id]['wins'],
+			losses=after[p.id]['losses'],
+			draws=after[p.id]['draws'],
+			streak=after[p.id]['streak'],
+			last_ranked_match_at=now
+		) for p in m.players]
+
+		# Write everything in a single transaction, one statement per table
+		timer = time.perf_counter()
+		async with db.transaction() as conn:
+			await conn.insert('qc_matches', dict(
+				match_id=m.id, channel_id=m.qc.id, queue_id=m.queue.cfg.p_key, queue_name=m.queue.name,
+				alpha_name=m.teams[0].name, beta_name=m.teams[1].name,
+				at=now, ranked=1, winner=winner,
+				alpha_score=scores[0], beta_score=scores[1], maps="\n".join(m.maps)
+			))
+			if m.qc.id != m.qc.rating.channel_id:
+				await conn.insert_many('qc_players', (
+					dict(channel_id=m.qc.id, user_id=p.id, nick=nicks[p.id])
+					for p in m.players
+				), on_dublicate="ignore")
+			await conn.insert_many('qc_players', players, on_dublicate="update")
+			await conn.insert_many('qc_player_matches', (
+				dict(match_id=m.id, channel_id=m.qc.id, user_id=p.id, nick=nicks[p.id], team=0 if p in m.teams[0] else 1)
+				for p in m.players
+			))
+			await conn.insert_many('qc_rating_history', (dict(
+				channel_id=m.qc.rating.channel_id,
+				user_id=p.id,
+				at=now,
+				rating_before=before[p.id]['rating'],
+				rating_change=after[p.id]['rating']-before[p.id]['rating'],
+				deviation_before=before[p.id]['deviation'],
+				deviation_change=after[p.id]['deviation']-before[p.id]['deviation'],
+				match_id=m.id,
+				reason=m.queue.name
+			) for p in m.players))
+		log.debug(f"Match {m.id} with {len(m.players)} players registered in {time.perf_counter()-timer:.3f}s.")
+
+		if m.qc.id != m.qc.rating.channel_id:
+			for p in m.players:
+				rating.cache.insert(m.qc.id, p.id, nick=nicks[p.id])
+		for row in players:
+			rating.cache.insert(row['channel_id'], row['user_id'])
+			rating.cache.update(**row)
+
+	# The match is registered at this point, discord errors must not make it be reported again
+	try:
+		await m.qc.update_rating_roles(*m.players)
+		await m.print_rating_results(ctx, before, after, winner)
+	except Exception as e:
+		log.error(f"Failed to announce rating results of match {m.id}: {str(e)}")
 
 
 async def undo_match(ctx, match_id):
@@ -237,35 +289,40 @@ async def undo_match(ctx, match_id):
 		return False
 
 	if match['ranked']:
-		p_matches = await db.select(('user_id', 'team'), 'qc_player_matches', where=dict(match_id=match_id))
-		p_history = iter_to_dict(
-			await db.select(
-				('user_id', 'rating_change', 'deviation_change'), 'qc_rating_history', where=dict(match_id=match_id)
-			), key='user_id'
-		)
-		stats = iter_to_dict(
-			await ctx.qc.rating.get_players((p['user_id'] for p in p_matches)), key='user_id'
-		)
-
-		for p in p_matches:
-			new = stats[p['user_id']]
-			changes = p_history[p['user_id']]
-
-			print(match['winner'])
-			if match['winner'] is None:
-				new['draws'] = max((new['draws'] - 1, 0))
-			elif match['winner'] == p['team']:
-				new['wins'] = max((new['wins'] - 1, 0))
-			else:
-				new['losses'] = max((new['losses'] - 1, 0))
-
-			new['rating'] = max((new['rating']-changes['rating_change'], 0))
-			new['deviation'] = max((new['deviation']-changes['deviation_change'], 0))
-
-			await db.update("qc_players", new, keys=dict(channel_id=ctx.qc.rating.channel_id, user_id=p['user_id']))
-		await db.delete("qc_rating_history", where=dict(match_id=match_id))
-		members = (ctx.channel.guild.get_member(p['user_id']) for p in p_matches)
-		await ctx.qc.update_rating_roles(*(m for m in members if m is not None))
+		async with rating.write_lock(ctx.qc.rating.channel_id):
+			p_matches = await db.select(('user_id', 'team'), 'qc_player_matches', where=dict(match_id=match_id))
+			p_history = iter_to_dict(
+				await db.select(
+					('user_id', 'rating_change', 'deviation_change'), 'qc_rating_history', where=dict(match_id=match_id)
+				), key='user_id'
+			)
+			stats = iter_to_dict(
+				await ctx.qc.rating.get_players((p['user_id'] for p in p_matches)), key='user_id'
+			)
+
+			for p in p_matches:
+				new = stats[p['user_id']]
+				changes = p_history[p['user_id']]
+
+				print(match['winner'])
+				if match['winner'] is None:
+					new['draws'] = max((new['draws'] - 1, 0))
+				elif match['winner'] == p['team']:
+					new['wins'] = max((new['wins'] - 1, 0))
+				else:
+					new['losses'] = max((new['losses'] - 1, 0))
+
+				new['rating'] = max((new['rating']-changes['rating_change'], 0))
+				new['deviation'] = max((new['deviation']-changes['deviation_change'], 0))
+
+				await db.update("qc_players", new, keys=dict(channel_id=ctx.qc.rating.channel_id, user_id=p['user_id']))
+				rating.cache.update(
+					ctx.qc.rating.channel_id, p['user_id'],
+					**{k: new[k] for k in ('rating', 'deviation', 'wins', 'losses', 'draws')}
+				)
+			await db.delete("qc_rating_history", where=dict(match_id=match_id))
+			members = (ctx.channel.guild.get_member(p['user_id']) for p in p_matches)
+			await ctx.qc.update_rating_roles(*(m for m in members if m is not None))
 
 	await db.delete('qc_player_matches', where=dict(match_id=match_id))
 	await db.delete('qc_matches', where=dict(match_id=match_id))
@@ -274,25 +331,34 @@ async def undo_match(ctx, match_id):
 
 async def reset_channel(channel_id):
 	where = {'channel_id': channel_id}
-	await db.delete("qc_players", where=where)
-	await db.delete("qc_rating_history", where=where)
-	await db.delete("qc_matches", where=where)
-	await db.delete("qc_player_matches", where=where)
+	async with rating.write_lock(channel_id):
+		async with db.transaction() as conn:
+			await conn.delete("qc_players", where=where)
+			await conn.delete("qc_rating_history", where=where)
+			await conn.delete("qc_matches", where=where)
+			await conn.delete("qc_player_matches", where=where)
+		rating.cache.drop(channel_id)
 
 
 async def reset_player(channel_id, user_id):
 	where = {'channel_id': channel_id, 'user_id': user_id}
-	await db.delete("qc_players", where=where)
-	await db.delete("qc_rating_history", where=where)
-	await db.delete("qc_player_matches", where=where)
+	async with rating.write_lock(channel_id):
+		async with db.transaction() as conn:
+			await conn.delete("qc_players", where=where)
+			await conn.delete("qc_rating_history", where=where)
+			await conn.delete("qc_player_matches", where=where)
+		rating.cache.remove(channel_id, user_id)
 
 
 async def replace_player(channel_id, user_id1, user_id2, new_nick):
-	await db.delete("qc_players", {'channel_id': channel_id, 'user_id': user_id2})
 	where = {'channel_id': channel_id, 'user_id': user_id1}
-	await db.update("qc_players", {'user_id': user_id2, 'nick': new_nick}, where)
-	await db.update("qc_rating_history", {'user_id': user_id2}, where)
-	await db.update("qc_player_matches", {'user_id': user_id2}, where)
+	async with rating.write_lock(channel_id):
+		async with db.transaction() as conn:
+			await conn.delete("qc_players", {'channel_id': channel_id, 'user_id': user_id2})
+			await conn.update("qc_players", {'user_id': user_id2, 'nick': new_nick}, where)
+			await conn.update("qc_rating_history", {'user_id': user_id2}, where)
+			await conn.update("qc_player_matches", {'user_id': user_id2}, where)
+		rating.cache.replace_user(channel_id, user_id1, user_id2, nick=new_nick)
 
 
 async def qc_stats(channel_id):
@@ -359,6 +425,7 @@ class StatsJobs:
 
 	def __init__(self):
 		self.next_decay_at = int(self.next_monday().timestamp())
+		scheduler.set('rating_decay', self.next_decay_at, self.run_weekly)
 
 	@staticmethod
 	def next_monday():
@@ -375,16 +442,30 @@ class StatsJobs:
 		return d
 
 	@staticmethod
-	async def apply_rating_decays():
+	async def apply_rating_decays(max_concurrent=4):
 		log.info("--- Applying weekly deviation decays ---")
-		for qc in bot.queue_channels.values():
-			await qc.apply_rating_decay()
-			await asyncio.sleep(1)
-
-	async def think(self, frame_time):
-		if frame_time > self.next_decay_at:
-			self.next_decay_at = int(self.next_monday().timestamp())
-			asyncio.create_task(self.apply_rating_decays())
+		semaphore = asyncio.Semaphore(max_concurrent)
+
+		async def apply(channel_id):
+			async with semaphore:
+				try:
+					if (qc := await bot.get_queue_channel(channel_id)) is not None:
+						await qc.apply_rating_decay()
+				except Exception as e:
+					log.error(f"Failed to apply rating decay on channel {channel_id}: {str(e)}")
+
+		# Only the channels not loaded yet that have decay enabled in their config are loaded
+		channel_ids = list(bot.queue_channels.keys()) + [
+			channel_id for channel_id, stub in bot.queue_channel_stubs.items()
+			if bot.QueueChannel.stub_decays(channel_id, stub['qc_row'])
+		]
+		await asyncio.gather(*(apply(channel_id) for channel_id in channel_ids))
+		log.info("--- Weekly deviation decays are done ---")
+
+	async def run_weekly(self, frame_time):
+		self.next_decay_at = int(self.next_monday().timestamp())
+		scheduler.set('rating_decay', self.next_decay_at, self.run_weekly)
+		asyncio.create_task(self.apply_rating_decays())
 
 
 jobs = StatsJobs()
@@ -11,6 +11,7 @@ import bot
 async def _leave_empty_guilds():
 	""" Leave all guilds which does not have any QueueChannels """
 	used_ids = set((qc.guild_id for qc in bot.queue_channels.values()))
+	used_ids.update((stub['guild_id'] for stub in bot.queue_channel_stubs.values()))
 	used_ids.add(110373943822540800)  # Discord bots guild
 	for guild in dc.guilds:
 		if guild.id not in used_ids:
@@ -29,8 +30,8 @@ async def leave_empty_guilds():
 
 async def _notice(text):
 	""" Send a text notification to all QueueChannels """
-	for qc in bot.queue_channels.values():
-		if (channel := dc.get_channel(qc.id)) is not None:
+	for channel_id in list(bot.queue_channels.keys()) + list(bot.queue_channel_stubs.keys()):
+		if (channel := dc.get_channel(channel_id)) is not None:
 			log.info(f"...Sending notice to {channel.guild.name}>{channel.name}...")
 			try:
 				await channel.send(text)
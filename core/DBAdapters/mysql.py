@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 import asyncio
+from time import perf_counter
+from contextlib import asynccontextmanager
+from functools import lru_cache
 import aiomysql
 from pymysql import err as mysqlErr
 from .common import *
+from .query_stats import QueryStats
 
 from core.console import log
 
@@ -23,18 +27,222 @@ reference_options = dict(
 	SET_DEFAULT='SET DEFAULT'
 )
 
-table_blank = dict(tname=None, columns=[], primary_keys=[], foreign_keys=[])
+table_blank = dict(tname=None, columns=[], primary_keys=[], foreign_keys=[], indexes=[])
 column_blank = dict(cname=None, ctype=Types.str, notnull=False, unique=False, autoincrement=False, default=None)
 fkey_blank = dict(cname=None, refTable=None, refColumn=None, on_delete=None, on_update=None)
+index_blank = dict(iname=None, columns=[], unique=False)  # iname defaults to idx_<columns>
 
 
-class Adapter:
+class Queries:
+	""" SQL helpers on top of execute(), executemany(), fetchone() and fetchall() of the subclass """
+
+	# Statement builders are memoized, arguments must be hashable: column and key names are passed as tuples
+
+	@staticmethod
+	@lru_cache(maxsize=1024)
+	def _mysql_insert(columns, table, on_dublicate):
+		return "{action}{ignore} INTO {table} ({columns}) VALUES({values}){update}".format(
+			action="REPLACE" if on_dublicate == 'replace' else "INSERT",
+			ignore=" IGNORE" if on_dublicate == 'ignore' else "",
+			table=table,
+			columns=", ".join((f"`{i}`" for i in columns)),
+			values=", ".join(('%s' for i in range(len(columns)))),
+			update=" ON DUPLICATE KEY UPDATE " + ", ".join((f"`{i}`=VALUES(`{i}`)" for i in columns))
+			if on_dublicate == 'update' else ""
+		)
+
+	@staticmethod
+	@lru_cache(maxsize=1024)
+	def _mysql_update(table, columns, keys):
+		where = " WHERE {}".format(" AND ".join(["`{}`=%s".format(i) for i in keys])) if len(keys) else ""
+		return "UPDATE {table} SET {columns}{where}".format(
+			table=table,
+			columns=",".join(["`{}`=%s".format(i) for i in columns]),
+			where=where
+		)
+
+	@staticmethod
+	@lru_cache(maxsize=1024)
+	def _mysql_select(columns, table, keys, order_by, order_asc, limit):
+		# fix queries where there are some restricted words, for example in MySQL 8 'rank' is restricted
+		sql_restricted_words = [
+				'rank',
+				'role',
+		]
+		columns = [f"`{col}`" if col in sql_restricted_words else col for col in columns]
+
+		return "SELECT {columns} FROM `{table}`{where}{order}{limit}".format(
+			columns=', '.join(columns),
+			table=table,
+			where=" WHERE " + " AND ".join(("`{}`=%s".format(k) for k in keys)) if keys else '',
+			order=" ORDER BY "+order_by+(" ASC" if order_asc else " DESC") if order_by else "",
+			limit=(" LIMIT " + str(limit)) if limit else ""
+		)
+
+	@staticmethod
+	@lru_cache(maxsize=1024)
+	def _mysql_delete(table, keys):
+		conditions = " WHERE " + " AND ".join(("`{}`=%s".format(k) for k in keys)) if keys else ''
+		return "DELETE FROM {}{}".format(table, conditions)
+
+	async def select(self, columns, table, where=None, order_by=None, order_asc=False, limit=None, one=False):
+		request = self._mysql_select(tuple(columns), table, tuple(where or ()), order_by, order_asc, limit)
+		args = list(where.values()) if where else ()
+
+		if one:
+			return await self.fetchone(request, args)
+		else:
+			return await self.fetchall(request, args)
+
+	async def select_one(self, *args, **kwargs):
+		return await self.select(*args, **kwargs, one=True)
+
+	async def delete(self, table, where=None):
+		args = list(where.values()) if where else ()
+		await self.execute(self._mysql_delete(table, tuple(where or ())), args)
+
+	async def insert(self, table, d, on_dublicate=None):
+		request = self._mysql_insert(tuple(d), table, on_dublicate)
+		return await self.execute(request, list(d.values()))
+
+	async def update(self, table, d, keys=None):
+		keys = keys or {}
+		request = self._mysql_update(table, tuple(d), tuple(keys))
+		await self.execute(request, list(d.values()) + list(keys.values()))
+
+	async def insert_many(self, table, it, on_dublicate=None):
+		try:
+			first, it = peek(iter(it))
+		except StopIteration:
+			return
+
+		request = self._mysql_insert(tuple(first), table, on_dublicate)
+		await self.executemany(request, (list(d.values()) for d in it))
+
+
+class Connection(Queries):
+	""" A single pool connection, used to run multiple statements on one connection or in one transaction """
+
+	def __init__(self, adapter, conn, wait=0):
+		self.adapter = adapter
+		self.conn = conn
+		self.wait = wait  # time spent waiting for the connection, accounted to the first statement
+
+	def _record(self, sql, started, rows):
+		self.adapter.stats.record(sql, self.wait, perf_counter() - started, rows)
+		self.wait = 0
+
+	async def execute(self, *args):
+		async with self.conn.cursor() as cur:
+			try:
+				started = perf_counter()
+				await cur.execute(*args)
+				self._record(args[0], started, cur.rowcount)
+				return cur.lastrowid
+			except Exception as e:
+				self.adapter.wrap_exc(e)
+
+	async def executemany(self, *args):
+		async with self.conn.cursor() as cur:
+			try:
+				started = perf_counter()
+				await cur.executemany(*args)
+				self._record(args[0], started, cur.rowcount)
+			except mysqlErr.Error as e:
+				self.adapter.wrap_exc(e)
+
+	async def fetchone(self, *args):
+		async with self.conn.cursor() as cur:
+			try:
+				started = perf_counter()
+				await cur.execute(*args)
+				row = await cur.fetchone()
+				self._record(args[0], started, 0 if row is None else 1)
+				return row
+			except mysqlErr.Error as e:
+				self.adapter.wrap_exc(e)
+
+	async def fetchall(self, *args):
+		async with self.conn.cursor() as cur:
+			try:
+				started = perf_counter()
+				await cur.execute(*args)
+				rows = await cur.fetchall()
+				self._record(args[0], started, len(rows))
+				return rows
+			except mysqlErr.Error as e:
+				self.adapter.wrap_exc(e)
+
+	@asynccontextmanager
+	async def stream(self, sql, args=None, batch_size=1000):
+		"""
+		Yield a Batches iterator over the result read with an unbuffered server side cursor:
+			async with conn.stream(sql, args) as batches:
+				async for rows in batches:
+		The cursor is closed on exit, the connection can not run other statements until then.
+		"""
+		async with self.conn.cursor(aiomysql.cursors.SSDictCursor) as cur:
+			try:
+				started = perf_counter()
+				await cur.execute(sql, args)
+				batches = Batches(cur, batch_size)
+				yield batches
+				self._record(sql, started, batches.count)
+			except mysqlErr.Error as e:
+				self.adapter.wrap_exc(e)
+
+	async def paginate(self, sql, args, key, column=None, batch_size=1000):
+		"""
+		Yield lists of up to batch_size rows of a big select using keyset pagination:
+			async for rows in conn.paginate("SELECT ... WHERE `channel_id`=%s", (channel_id, ), 'user_id'):
+		sql must end with its WHERE clause, it is extended with `AND column>%s ORDER BY column LIMIT batch_size`.
+		key is a unique column of the result, column is its sql expression and defaults to the key name.
+		Unlike stream() the connection can run other statements between the batches, use it inside transactions.
+		"""
+		column = column or f"`{key}`"
+		last = None
+		while True:
+			rows = await self.fetchall(
+				sql + ("" if last is None else f" AND {column}>%s") + f" ORDER BY {column} LIMIT {int(batch_size)}",
+				tuple(args) if last is None else (*args, last)
+			)
+			if len(rows):
+				yield rows
+			if len(rows) < batch_size:
+				return
+			last = rows[-1][key]
+
+
+class Batches:
+	""" Async iterator over lists of up to batch_size rows of a cursor, see Connection.stream() """
+
+	def __init__(self, cur, batch_size):
+		self.cur = cur
+		self.batch_size = batch_size
+		self.count = 0  # rows read so far
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		if not len(rows := await self.cur.fetchmany(self.batch_size)):
+			raise StopAsyncIteration
+		self.count += len(rows)
+		return rows
+
+
+class Adapter(Queries):
 	pool: aiomysql.Pool
 	loop: asyncio.AbstractEventLoop
 	types = Types
 	errors = Errors
 
-	def __init__(self, db_address):
+	def __init__(self, db_address, minsize=1, maxsize=10, recycle=3600, connect_timeout=10):
+		self.tables = dict()  # {tname: table}, declared by ensure_table()
+		self.stats = QueryStats()
+		self.pool_options = dict(minsize=minsize, maxsize=maxsize, pool_recycle=recycle, connect_timeout=connect_timeout)
+		self.acquire_stats = dict(count=0, total=0.0, max=0.0)  # pool connection wait times
+		self._waiting = 0  # coroutines waiting for a pool connection
 		self.dbAddress = db_address
 		try:
 			self.dbUser, db_address = db_address.split(':', 1)
@@ -57,45 +265,93 @@ class Adapter:
 				db=self.dbName,
 				charset='utf8mb4',
 				autocommit=True,
-				cursorclass=aiomysql.cursors.DictCursor)
+				cursorclass=aiomysql.cursors.DictCursor,
+				**self.pool_options
+			)
 
 		except mysqlErr.Error as e:
 			self.wrap_exc(e)
 
+	@asynccontextmanager
+	async def _acquire(self):
+		""" Yield (connection, seconds waited for it) from the pool """
+		started = perf_counter()
+		self._waiting += 1
+		try:
+			conn = await self.pool.acquire()
+		finally:
+			self._waiting -= 1
+
+		wait = perf_counter() - started
+		self.acquire_stats['count'] += 1
+		self.acquire_stats['total'] += wait
+		self.acquire_stats['max'] = max(self.acquire_stats['max'], wait)
+		try:
+			yield conn, wait
+		finally:
+			await self.pool.release(conn)
+
+	def pool_stats(self):
+		""" Return current pool usage and connection acquire latency """
+		return dict(
+			minsize=self.pool.minsize,
+			maxsize=self.pool.maxsize,
+			in_use=self.pool.size - self.pool.freesize,
+			free=self.pool.freesize,
+			waiters=self._waiting,
+			acquires=self.acquire_stats['count'],
+			acquire_avg=self.acquire_stats['total'] / (self.acquire_stats['count'] or 1),
+			acquire_max=self.acquire_stats['max']
+		)
+
+	@asynccontextmanager
+	async def connection(self):
+		""" Run multiple autocommitted statements on the yielded Connection without returning it to the pool """
+		async with self._acquire() as (conn, wait):
+			yield Connection(self, conn, wait)
+
+	@asynccontextmanager
+	async def transaction(self):
+		""" Run statements on the yielded Connection, commit on exit or rollback on exception """
+		async with self._acquire() as (conn, wait):
+			started = perf_counter()
+			try:
+				await conn.begin()
+				yield Connection(self, conn, wait)
+				await conn.commit()
+				self.stats.record("BEGIN ... COMMIT", 0, perf_counter() - started, 0)
+			except mysqlErr.Error as e:
+				await conn.rollback()
+				self.wrap_exc(e)
+			except BaseException:
+				await conn.rollback()
+				raise
+
 	async def execute(self, *args):
-		async with self.pool.acquire() as conn:
-			async with conn.cursor() as cur:
-				try:
-					await cur.execute(*args)
-					return cur.lastrowid
-				except Exception as e:
-					self.wrap_exc(e)
+		async with self.connection() as conn:
+			return await conn.execute(*args)
 
 	async def executemany(self, *args):
-		async with self.pool.acquire() as conn:
-			async with conn.cursor() as cur:
-				try:
-					await cur.executemany(*args)
-				except mysqlErr.Error as e:
-					self.wrap_exc(e)
+		async with self.connection() as conn:
+			await conn.executemany(*args)
 
 	async def fetchone(self, *args):
-		async with self.pool.acquire() as conn:
-			async with conn.cursor() as cur:
-				try:
-					await cur.execute(*args)
-					return await cur.fetchone()
-				except mysqlErr.Error as e:
-					self.wrap_exc(e)
+		async with self.connection() as conn:
+			return await conn.fetchone(*args)
 
 	async def fetchall(self, *args):
-		async with self.pool.acquire() as conn:
-			async with conn.cursor() as cur:
-				try:
-					await cur.execute(*args)
-					return await cur.fetchall()
-				except mysqlErr.Error as e:
-					self.wrap_exc(e)
+		async with self.connection() as conn:
+			return await conn.fetchall(*args)
+
+	@asynccontextmanager
+	async def stream(self, sql, args=None, batch_size=1000):
+		"""
+		Yield a Batches iterator over a big result set on a dedicated connection, see Connection.stream().
+		It takes a second pool connection when used inside a transaction, use Connection.paginate() there.
+		"""
+		async with self.connection() as conn:
+			async with conn.stream(sql, args, batch_size) as batches:
+				yield batches
 
 	@staticmethod
 	def _mysql_column(kwargs):
@@ -119,22 +375,14 @@ class Adapter:
 		)
 
 	@staticmethod
-	def _mysql_insert(columns, table, on_dublicate):
-		return "{action}{ignore} INTO {table} ({columns}) VALUES({values})".format(
-			action="REPLACE" if on_dublicate == 'replace' else "INSERT",
-			ignore=" IGNORE" if on_dublicate == 'ignore' else "",
-			table=table,
-			columns=", ".join((f"`{i}`" for i in columns)),
-			values=", ".join(('%s' for i in range(len(columns))))
-		)
-
-	@staticmethod
-	def _mysql_update(table, columns, keys):
-		where = " WHERE {}".format(" AND ".join(["`{}`=%s".format(i) for i in keys])) if len(keys) else ""
-		return "UPDATE {table} SET {columns}{where}".format(
-			table=table,
-			columns=",".join(["`{}`=%s".format(i) for i in columns]),
-			where=where
+	def _index_name(kwargs):
+		return kwargs['iname'] or "idx_" + "_".join(kwargs['columns'])
+
+	def _mysql_index(self, kwargs):
+		return "{unique}INDEX `{iname}` ({columns})".format(
+			unique="UNIQUE " if kwargs['unique'] else "",
+			iname=self._index_name(kwargs),
+			columns=", ".join((f"`{i}`" for i in kwargs['columns']))
 		)
 
 	async def create_table(self, table):
@@ -142,99 +390,61 @@ class Adapter:
 
 		columns = [self._mysql_column({**column_blank, **col}) for col in table['columns']]
 		fkeys = ["FOREIGN KEY " + self._mysql_fkey({**fkey_blank, **fkey}) for fkey in table['foreign_keys']]
+		indexes = [self._mysql_index({**index_blank, **index}) for index in table['indexes']]
 		pkeys = ", PRIMARY KEY(" + ", ".join(table['primary_keys']) + ')' if len(table['primary_keys']) else ''
 
 		request = "CREATE TABLE {tname} ({tdeskr})".format(
 			tname=table['tname'],
-			tdeskr=", ".join((columns + fkeys)) + pkeys
+			tdeskr=", ".join((columns + fkeys + indexes)) + pkeys
 		)
 
 		await self.execute(request)
 
 	def ensure_table(self, table):
-		self.loop.run_until_complete(self._ensure_table(table))
+		""" Declare a table, it is created or updated with the other declared tables by ensure_tables() """
+		self.tables[table['tname']] = {**table_blank, **table}
 
-	async def _ensure_table(self, table):
-		table = {**table_blank, **table}
-		columns = await self.fetchall("\n".join((
-			"SELECT COLUMN_NAME, DATA_TYPE FROM INFORMATION_SCHEMA.COLUMNS",
-			"WHERE TABLE_NAME = '{}' AND TABLE_SCHEMA = '{}'".format(table['tname'], self.dbName)
-		)))
-		columns = {i['COLUMN_NAME']: i['DATA_TYPE'] for i in columns}
-
-		# Create table if not exist
-		if not len(columns):
-			await self.create_table(table)
+	async def ensure_tables(self):
+		""" Create missing tables, columns and indexes of all declared tables in one pass """
+		if not len(self.tables):
 			return
-
-		# Create columns if not exist
-		for col in table['columns']:
-			col = {**column_blank, **col}
-			if col['cname'] not in columns.keys():
-				await self.execute("ALTER TABLE {tname} ADD COLUMN {column_sql}".format(
-					tname=table['tname'],
-					column_sql=self._mysql_column({**column_blank, **col})
-				))
-				# Add a foreign key if needed
-				for fkey in (fkey for fkey in table['foreign_keys'] if fkey['cname'] == col['cname']):
-					await self.execute("ALTER TABLE {tname} ADD FOREIGN KEY {fkey_sql}".format(
-						tname=table['tname'],
-						fkey_sql=self._mysql_fkey({**fkey_blank, **fkey})
-					))
-			elif not col['ctype'].lower().startswith(columns[col['cname']]):
-				raise(TypeError(
-					"Column '{}' types are mismatching, {} and {}".format(col['cname'], col['ctype'], columns[col['cname']])
-				))
-
-	async def select(self, columns, table, where=None, order_by=None, order_asc=False, limit=None, one=False):
-		conditions = " WHERE " + " AND ".join(("`{}`=%s".format(k) for k in where.keys())) if where else ''
-		args = list(where.values()) if where else ()
-
-		# fix queries where there are some restricted words, for example in MySQL 8 'rank' is restricted
-		sql_restricted_words = [
-				'rank',
-				'role',
-		]
-		columns = [f"`{col}`" if col in sql_restricted_words else col for col in columns]
-
-		request = "SELECT {columns} FROM `{table}`{where}{order}{limit}".format(
-			columns=', '.join(columns),
-			table=table,
-			where=conditions,
-			order=" ORDER BY "+order_by+(" ASC" if order_asc else " DESC") if order_by else "",
-			limit=(" LIMIT " + str(limit)) if limit else ""
-		)
-
-		if one:
-			return await self.fetchone(request, args)
-		else:
-			return await self.fetchall(request, args)
-
-	async def select_one(self, *args, **kwargs):
-		return await self.select(*args, **kwargs, one=True)
-
-	async def delete(self, table, where=None):
-		conditions = " WHERE " + " AND ".join(("`{}`=%s".format(k) for k in where.keys())) if where else ''
-		args = list(where.values()) if where else ()
-		await self.execute("DELETE FROM {}{}".format(table, conditions), args)
-
-	async def insert(self, table, d, on_dublicate=None):
-		request = self._mysql_insert(d.keys(), table, on_dublicate)
-		return await self.execute(request, list(d.values()))
-
-	async def update(self, table, d, keys=None):
-		keys = keys or {}
-		request = self._mysql_update(table, d.keys(), keys.keys())
-		await self.execute(request, list(d.values()) + list(keys.values()))
-
-	async def insert_many(self, table, it, on_dublicate=None):
-		try:
-			first, it = peek(iter(it))
-		except StopIteration:
-			return
-
-		request = self._mysql_insert(first.keys(), table, on_dublicate)
-		await self.executemany(request, (list(d.values()) for d in it))
+		where = "WHERE TABLE_SCHEMA = %s AND TABLE_NAME IN ({})".format(", ".join(["%s"] * len(self.tables)))
+		args = (self.dbName, *self.tables.keys())
+
+		columns = dict()  # {tname: {cname: data_type}}
+		for i in await self.fetchall("SELECT TABLE_NAME, COLUMN_NAME, DATA_TYPE FROM INFORMATION_SCHEMA.COLUMNS " + where, args):
+			columns.setdefault(i['TABLE_NAME'], dict())[i['COLUMN_NAME']] = i['DATA_TYPE']
+		indexes = dict()  # {tname: {index_name}}
+		for i in await self.fetchall("SELECT DISTINCT TABLE_NAME, INDEX_NAME FROM INFORMATION_SCHEMA.STATISTICS " + where, args):
+			indexes.setdefault(i['TABLE_NAME'], set()).add(i['INDEX_NAME'])
+
+		for table in self.tables.values():
+			# Create table if not exist
+			if table['tname'] not in columns:
+				await self.create_table(table)
+				continue
+
+			# Collect missing columns, foreign keys and indexes into a single ALTER TABLE statement
+			alter = []
+			for col in table['columns']:
+				col = {**column_blank, **col}
+				if col['cname'] not in columns[table['tname']]:
+					alter.append("ADD COLUMN " + self._mysql_column(col))
+					for fkey in (fkey for fkey in table['foreign_keys'] if fkey['cname'] == col['cname']):
+						alter.append("ADD FOREIGN KEY " + self._mysql_fkey({**fkey_blank, **fkey}))
+				elif not col['ctype'].lower().startswith(columns[table['tname']][col['cname']]):
+					raise(TypeError("Column '{}' types are mismatching, {} and {}".format(
+						col['cname'], col['ctype'], columns[table['tname']][col['cname']]
+					)))
+
+			for index in table['indexes']:
+				index = {**index_blank, **index}
+				if self._index_name(index) not in indexes.get(table['tname'], ()):
+					alter.append("ADD " + self._mysql_index(index))
+
+			if len(alter):
+				log.info("Updating table {}: {}...".format(table['tname'], ", ".join(alter)))
+				await self.execute("ALTER TABLE {tname} {alter}".format(tname=table['tname'], alter=", ".join(alter)))
 
 	async def close(self):
 		self.pool.close()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import traceback
+from collections import deque
+from functools import lru_cache
+from prettytable import PrettyTable
+
+from core.console import log
+
+
+class QueryStats:
+	"""
+	Per statement template timings of the database adapter.
+	Statistics are collected only while enabled, statements slower than slow_query_time (seconds)
+	are logged with their call site whenever it is set.
+	"""
+
+	samples = 1000  # last durations kept per template to calculate percentiles
+	max_templates = 1000  # statements of new templates are accounted under other_template once reached
+	other_template = "(other statements)"
+
+	_literals = re.compile(r"'(?:[^'\\]|\\.)*'|\b\d+(?:\.\d+)?\b")
+	_in_lists = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+
+	def __init__(self, enabled=False, slow_query_time=None):
+		self.enabled = enabled
+		self.slow_query_time = slow_query_time
+		self.templates = dict()  # {sql: dict(count, total, wait, max, rows, durations)}
+
+	def record(self, sql, wait, duration, rows):
+		""" Account a statement, wait is time spent waiting for a pool connection, duration is execution time """
+		if self.slow_query_time and duration >= self.slow_query_time:
+			log.info("Slow query ({:.3f}s, {:.3f}s pool wait) at {}: {}".format(
+				duration, wait, self._call_site(), " ".join(sql.split())[:500]
+			))
+		if not self.enabled:
+			return
+
+		sql = self.template(sql)
+		if (t := self.templates.get(sql)) is None:
+			if len(self.templates) >= self.max_templates:
+				sql = self.other_template
+			t = self.templates.setdefault(sql, dict(count=0, total=0.0, wait=0.0, max=0.0, rows=0, durations=deque(maxlen=self.samples)))
+		t['count'] += 1
+		t['total'] += duration
+		t['wait'] += wait
+		t['max'] = max(t['max'], duration)
+		t['rows'] += rows or 0
+		t['durations'].append(duration)
+
+	@classmethod
+	@lru_cache(maxsize=4096)
+	def template(cls, sql):
+		"""
+		Return the statement template the sql is accounted under: literals and placeholders are replaced
+		with ?, IN lists are collapsed to IN (...) and whitespace is squeezed.
+		"""
+		sql = cls._literals.sub("?", " ".join(sql.split()).replace("%s", "?"))
+		return cls._in_lists.sub("IN (...)", sql)
+
+	@staticmethod
+	def _call_site():
+		""" Return the innermost frame outside of the db adapter and the standard library """
+		adapters_dir = os.path.dirname(__file__)
+		stdlib_dir = os.path.dirname(traceback.__file__)
+		for frame in reversed(traceback.extract_stack()[:-2]):
+			if not frame.filename.startswith((adapters_dir, stdlib_dir)):
+				return f"{frame.filename}:{frame.lineno} in {frame.name}"
+		return "unknown"
+
+	def reset(self):
+		self.templates = dict()
+
+	def top(self, n=10, order_by='total'):
+		""" Return a table of the top n templates sorted by total, count, max, wait or rows, call from the console """
+		rows = []
+		for sql, t in sorted(self.templates.items(), key=lambda i: i[1][order_by], reverse=True)[:n]:
+			durations = sorted(t['durations'])
+			rows.append([
+				sql[:80], t['count'], f"{t['total']:.3f}",
+				f"{durations[len(durations) // 2] * 1000:.1f}",
+				f"{durations[min(len(durations) - 1, int(len(durations) * 0.95))] * 1000:.1f}",
+				f"{t['max'] * 1000:.1f}", f"{t['wait'] / t['count'] * 1000:.1f}", t['rows']
+			])
+
+		table = PrettyTable()
+		table.field_names = ["statement", "count", "total s", "p50 ms", "p95 ms", "max ms", "avg wait ms", "rows"]
+		table.align["statement"] = "l"
+		table.add_rows(rows)
+		return "\n" + table.get_string()
@@ -5,6 +5,11 @@ import emoji
 import json
 from nextcord import Guild
 
+try:
+	from orjson import loads as json_loads
+except ModuleNotFoundError:  # orjson is optional, it only speeds up configs loading
+	from json import loads as json_loads
+
 from core.database import db
 from core.client import dc
 from core.utils import format_emoji, parse_duration, seconds_to_str
@@ -40,8 +45,16 @@ class Variable:
 
 	async def wrap(self, value, guild: Guild):
 		""" Return useful objects like role from role_id string etc """
+		return self.wrap_sync(value, guild)
+
+	def wrap_sync(self, value, guild: Guild):
+		""" Synchronous implementation of wrap(), override wrap() instead if wrapping needs to await anything """
 		return value
 
+	def is_sync(self) -> bool:
+		""" Return True if wrap() can be replaced with wrap_sync() """
+		return type(self).wrap is Variable.wrap
+
 	def readable(self, obj):
 		""" returns string from a useful object"""
 		return str(obj) if obj is not None else None
@@ -58,6 +71,8 @@ class Variable:
 class FactoryTable:
 	""" Database table representation that is passed to a CfgFactory object. """
 
+	tables = []  # all created FactoryTable objects, see ensure_versions()
+
 	def __init__(self, name: str, p_key: str, f_key: Optional[str] = None):
 		self.name = name
 		self.p_key = p_key
@@ -78,16 +93,7 @@ class FactoryTable:
 			],
 			primary_keys=[self.p_key]
 		))
-
-		db.loop.run_until_complete(self.ensure_versions())
-
-	async def ensure_versions(self) -> None:
-		""" Ensure all rows in the table have correct FACTORY_VERSION """
-		if any((
-			row['factory_version'] != FACTORY_VERSION
-			for row in await db.select(['factory_version'], self.name)
-		)):
-			raise ValueError("Not all the existing table rows have the correct factory_version, please run `update_db.py` script.")
+		FactoryTable.tables.append(self)
 
 	async def get_next_p_key(self) -> int:
 		""" Get next primary key value """
@@ -96,6 +102,22 @@ class FactoryTable:
 		return data.get(self.p_key)+1 if data else 0
 
 
+async def ensure_versions() -> None:
+	""" Ensure all rows in all factory tables have correct FACTORY_VERSION """
+	if not len(FactoryTable.tables):
+		return
+
+	data = await db.fetchone(
+		"SELECT SUM(`count`) AS `count` FROM (" + " UNION ALL ".join((
+			f"SELECT COUNT(*) AS `count` FROM `{table.name}` WHERE `factory_version` IS NULL OR `factory_version`!=%s"
+			for table in FactoryTable.tables
+		)) + ") AS `outdated`",
+		[FACTORY_VERSION] * len(FactoryTable.tables)
+	)
+	if data['count']:
+		raise ValueError("Not all the existing table rows have the correct factory_version, please run `update_db.py` script.")
+
+
 class CfgFactory:
 	""" ConfigFactory describes the config structure and manages creation/loading of its Config objects """
 
@@ -110,6 +132,8 @@ class CfgFactory:
 		self.sections = sections
 		self.variables = {v.name: v for v in variables}
 		self.blank = {v.name: v.default for v in self.variables.values()}
+		# Precompiled (name, default, variable, is_sync) list for Config.load()
+		self.loaders = [(v.name, v.default, v, v.is_sync()) for v in self.variables.values()]
 
 	async def spawn(self, guild: Guild, p_key: Optional[int] = None, f_key: Optional[int] = None):
 		""" Load existing Config from db by given p_key if exists or spawn a new one """
@@ -134,6 +158,16 @@ class CfgFactory:
 		rows = await db.select(['*'], self.table.name, keys)
 		return [await Config.load(self, row, guild) for row in rows]
 
+	async def select_rows(self):
+		""" Return raw db rows of all configs related to this class, use load() to turn them into Config objects """
+
+		return await db.select(['*'], self.table.name, where={'cfg_name': self.name})
+
+	async def load(self, row: dict, guild: Guild):
+		""" Load Config object from an already fetched db row """
+
+		return await Config.load(self, row, guild)
+
 	async def p_keys(self):
 		""" Return all config p_keys related to this class """
 
@@ -150,14 +184,16 @@ class Config:
 		self = Config(cfg_factory, row, guild)
 
 		# Wrap database data into useful objects and update self attributes
-		cfg_data = json.loads(row['cfg_data'])
-		for var in self._factory.variables.values():
+		cfg_data = json_loads(row['cfg_data'])
+		objects = dict()
+		for name, default, var, is_sync in cfg_factory.loaders:
+			value = cfg_data.get(name, default)
 			try:
-				obj = await var.wrap(cfg_data.get(var.name, var.default), guild)
+				objects[name] = var.wrap_sync(value, guild) if is_sync else await var.wrap(value, guild)
 			except Exception as e:
-				log.error("Failed to wrap variable '{}': {}".format(var.name, str(e)))
-				obj = await var.wrap(var.default, guild)
-			setattr(self, var.name, obj)
+				log.error("Failed to wrap variable '{}': {}".format(name, str(e)))
+				objects[name] = var.wrap_sync(default, guild) if is_sync else await var.wrap(default, guild)
+		self.__dict__.update(objects)
 
 		return self
 
@@ -169,7 +205,7 @@ class Config:
 	def __init__(self, cfg_factory: CfgFactory, row: dict, guild: Guild):
 		self._guild_id = guild.id
 		self._factory = cfg_factory
-		self.cfg_info = json.loads(row.pop("cfg_info"))
+		self.cfg_info = json_loads(row.pop("cfg_info"))
 		self.p_key = row.pop(cfg_factory.table.p_key)
 
 	async def update(self, data: dict) -> None:
@@ -354,7 +390,7 @@ class RoleVar(Variable):
 
 		return role_id
 
-	async def wrap(self, value, guild):
+	def wrap_sync(self, value, guild):
 		if value:
 			role = guild.get_role(value)
 			if role:
@@ -403,7 +439,7 @@ class MemberVar(Variable):
 
 		return user_id
 
-	async def wrap(self, value, guild):
+	def wrap_sync(self, value, guild):
 		if value:
 			member = guild.get_member(value)
 			if member:
@@ -450,7 +486,7 @@ class TextChanVar(Variable):
 
 		return channel_id
 
-	async def wrap(self, value, guild):
+	def wrap_sync(self, value, guild):
 		if value:
 			channel = guild.get_channel(value)
 			if channel:
@@ -486,9 +522,6 @@ class DurationVar(Variable):
 		except ValueError:
 			raise ValueError("Invalid duration format.")
 
-	async def wrap(self, value, guild):
-		return value
-
 	def readable(self, obj):
 		if obj:
 			#  return seconds_to_str(obj)
@@ -529,6 +562,15 @@ class VariableTable(Variable):
 				{var_name: await self.variables[var_name].wrap(value, guild) for var_name, value in row.items()})
 		return wrapped
 
+	def is_sync(self) -> bool:
+		return all((var.is_sync() for var in self.variables.values()))
+
+	def wrap_sync(self, data, guild):
+		return [
+			{var_name: self.variables[var_name].wrap_sync(value, guild) for var_name, value in row.items()}
+			for row in data
+		]
+
 	def readable(self, l):
 		return [{var_name: self.variables[var_name].readable(value) for var_name, value in d.items()} for d in l]
 
@@ -4,10 +4,16 @@ from importlib import import_module
 from core.config import cfg
 
 
-def init_db(db_uri):
+def init_db(db_uri, **options):
 	db_type, db_address = db_uri.split("://", 1)
 	adapter = import_module('core.DBAdapters.' + db_type)
-	return adapter.Adapter(db_address)
+	return adapter.Adapter(db_address, **options)
 
 
-db = init_db(cfg.DB_URI)
+# Only the pool options set in the config are passed, the adapter defaults apply to the rest
+pool_options = dict(
+	minsize='DB_POOL_MINSIZE', maxsize='DB_POOL_MAXSIZE', recycle='DB_POOL_RECYCLE', connect_timeout='DB_CONNECT_TIMEOUT'
+)
+db = init_db(cfg.DB_URI, **{key: getattr(cfg, name) for key, name in pool_options.items() if hasattr(cfg, name)})
+db.stats.enabled = getattr(cfg, 'DB_QUERY_STATS', False)  # see database.db.stats.top() from the console
+db.stats.slow_query_time = getattr(cfg, 'DB_SLOW_QUERY_TIME', 1.0)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import time
+import heapq
+import asyncio
+import traceback
+from itertools import count
+
+from core.console import log
+
+
+class Scheduler:
+	"""
+	Runs coroutine functions at given absolute timestamps, sleeping until the nearest one.
+	Every job has a key, setting a job with an existing key replaces the previous one.
+	Due jobs run concurrently, at most max_concurrent at a time.
+	"""
+
+	def __init__(self, max_concurrent=20):
+		self.max_concurrent = max_concurrent
+		self.jobs = dict()  # {key: job}
+		self.heap = []  # [job], replaced and cancelled jobs are skipped on pop
+		self._counter = count()
+		self._wakeup = None  # asyncio.Event, created by run()
+		self._semaphore = None  # asyncio.Semaphore, created by run()
+		self._running = set()  # {Task}
+
+	def set(self, key, at, coro_func):
+		""" Call await coro_func(frame_time) as soon as time.time() >= at """
+		job = (at, next(self._counter), key, coro_func)
+		self.jobs[key] = job
+		heapq.heappush(self.heap, job)
+
+		# Drop stale jobs if they pile up
+		if len(self.heap) > 2 * len(self.jobs) + 64:
+			self.heap = list(self.jobs.values())
+			heapq.heapify(self.heap)
+
+		if self._wakeup and self.heap[0] is job:
+			self._wakeup.set()
+
+	def get(self, key):
+		""" Return timestamp of the job or None """
+		if (job := self.jobs.get(key)) is not None:
+			return job[0]
+
+	def cancel(self, key):
+		self.jobs.pop(key, None)
+
+	def _next_at(self):
+		while len(self.heap) and self.jobs.get(self.heap[0][2]) is not self.heap[0]:
+			heapq.heappop(self.heap)
+		return self.heap[0][0] if len(self.heap) else None
+
+	async def _run_job(self, key, coro_func):
+		async with self._semaphore:
+			try:
+				await coro_func(time.time())
+			except Exception as e:
+				log.error('Error running scheduled job {} from {}: {}\n{}'.format(
+					key, coro_func.__module__, str(e), traceback.format_exc()
+				))
+
+	async def run(self):
+		self._wakeup = asyncio.Event()
+		self._semaphore = asyncio.Semaphore(self.max_concurrent)
+		while True:
+			if (at := self._next_at()) is None or (timeout := at - time.time()) > 0:
+				try:
+					await asyncio.wait_for(self._wakeup.wait(), timeout=None if at is None else timeout)
+				except asyncio.TimeoutError:
+					pass
+				self._wakeup.clear()
+				continue
+
+			at, _, key, coro_func = heapq.heappop(self.heap)
+			self.jobs.pop(key)
+			task = asyncio.create_task(self._run_job(key, coro_func))
+			self._running.add(task)
+			task.add_done_callback(self._running.discard)
+
+
+scheduler = Scheduler()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from core.config import cfg
+from core.console import log
+
+
+class WorkerPool:
+	"""
+	Runs CPU heavy functions in worker processes so they do not block the event loop.
+	Functions must be module level callables taking and returning plain picklable data.
+	With max_workers=0, or where fork start method is not available, functions are run inline.
+	"""
+
+	def __init__(self, max_workers=2, timeout=10):
+		self.max_workers = max_workers
+		self.timeout = timeout
+		self.executor = None
+
+	@property
+	def enabled(self):
+		# Workers are forked as the main script can not be safely imported by a spawned process
+		return self.max_workers > 0 and 'fork' in multiprocessing.get_all_start_methods()
+
+	def _get_executor(self):
+		if self.executor is None:
+			self.executor = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context('fork'))
+		return self.executor
+
+	async def run(self, func, *args, timeout=None, fallback=None):
+		"""
+		Return func(*args) computed by a worker, or inline if the workers are disabled.
+		If the worker does not return in time, fallback() is returned if given, otherwise asyncio.TimeoutError is raised.
+		The fallback runs on the event loop and must be cheap, heavy jobs are never recomputed inline.
+		A broken pool is restarted and the job is retried on it once.
+		"""
+		if not self.enabled:
+			return func(*args)
+
+		for retry in (False, True):
+			try:
+				return await asyncio.wait_for(
+					asyncio.get_running_loop().run_in_executor(self._get_executor(), func, *args),
+					timeout=timeout or self.timeout
+				)
+			except asyncio.TimeoutError:
+				if fallback is None:
+					log.error(f"Worker pool did not return {func.__name__} in time.")
+					raise
+				log.error(f"Worker pool did not return {func.__name__} in time, using the fallback.")
+				return fallback()
+			except BrokenProcessPool:
+				self.executor = None
+				if retry:
+					raise
+				log.error(f"Worker pool is broken, restarting it and retrying {func.__name__}.")
+
+	def shutdown(self):
+		if self.executor is not None:
+			self.executor.shutdown(wait=False, cancel_futures=True)
+			self.executor = None
+
+
+workers = WorkerPool(
+	max_workers=getattr(cfg, 'WORKER_PROCESSES', 2),
+	timeout=getattr(cfg, 'WORKER_TIMEOUT', 10)
+)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar rating engine parity with the rating classes, with and without numpy.
+Run from the bot directory (config.cfg is required): python -m unittest discover tests
+"""
+import random
+import unittest
+
+from bot.stats import rating_engine as engine
+from bot.stats.rating import FlatRating, TrueSkillRating, Glicko2Rating
+
+COLUMNS = ('rating', 'deviation', 'wins', 'losses', 'draws', 'streak')
+
+
+def random_rating(rnd, rating_cls):
+	return rating_cls(
+		channel_id=1, scale=rnd.choice([50, 100, 133]), win_scale=rnd.choice([100, 105, 150]),
+		loss_scale=rnd.choice([95, 100, 300]), draw_bonus=rnd.choice([0, 10, 33]),
+		ws_boost=rnd.random() < 0.5, ls_boost=rnd.random() < 0.5, min_deviation=rnd.choice([None, 50])
+	)
+
+
+def random_rows(rnd, count, min_deviation=0):
+	return [dict(
+		user_id=user_id, rating=rnd.randint(0, 3000), deviation=rnd.randint(min_deviation, 350),
+		wins=rnd.randint(0, 50), losses=rnd.randint(0, 50), draws=rnd.randint(0, 5),
+		streak=rnd.randint(-7, 7), last_ranked_match_at=rnd.randint(0, 1000)
+	) for user_id in range(count)]
+
+
+class TestRatingEngine(unittest.TestCase):
+
+	def column_kinds(self):
+		return (False, True) if engine.numpy is not None else (False, )
+
+	def test_scale_changes(self):
+		rnd = random.Random(14)
+		for _ in range(300):
+			rating = random_rating(rnd, FlatRating)
+			rows = random_rows(rnd, rnd.randint(1, 50))
+			idx = rnd.sample(range(len(rows)), rnd.randint(1, len(rows)))
+			r_change = [rnd.uniform(-80, 80) for _ in idx]
+			d_change = [rnd.uniform(-30, 30) for _ in idx]
+			score = [rnd.choice((-1, 0, 1)) for _ in idx]
+			expected = [
+				{k: p[k] for k in ('user_id', *COLUMNS)}
+				for p in (rating._scale_changes(rows[i], r, d, s) for i, r, d, s in zip(idx, r_change, d_change, score))
+			]
+
+			for use_numpy in self.column_kinds():
+				cols = engine.PlayerColumns(rows, use_numpy=use_numpy)
+				if use_numpy:  # scale_changes() would fall back to python on a mismatch
+					engine._scale_changes_numpy(rating, cols, idx, r_change, d_change, score)
+				else:
+					engine._scale_changes_python(rating, cols, idx, r_change, d_change, score)
+				self.assertEqual(cols.rows(idx), expected, (rating.params, use_numpy))
+
+	def test_replay(self):
+		rnd = random.Random(15)
+		for rating_cls, runs in ((FlatRating, 100), (TrueSkillRating, 30), (Glicko2Rating, 10)):
+			for _ in range(runs):
+				rating = random_rating(rnd, rating_cls)
+				rows = random_rows(rnd, rnd.randint(4, 30), min_deviation=50)
+				games = []
+				for _ in range(rnd.randint(1, 40)):
+					players = rnd.sample(range(len(rows)), 4)
+					scores = rnd.choice((None, (1, 0), (0, 1), (rnd.randint(0, 5), rnd.randint(0, 5))))
+					games.append((players[:2], players[2:], scores))
+
+				expected = [dict(p) for p in rows]
+				for a, b, scores in games:
+					after = rating.rate_rounds([expected[i] for i in a], [expected[i] for i in b], scores)
+					for i, p in zip((*a, *b), (*after[0], *after[1])):
+						expected[i] = p
+
+				for use_numpy in self.column_kinds():
+					cols = engine.PlayerColumns(rows, use_numpy=use_numpy)
+					engine.replay(rating, cols, games)
+					self.assertEqual(
+						cols.rows(), [{k: p[k] for k in ('user_id', *COLUMNS)} for p in expected],
+						(rating_cls, rating.params, use_numpy)
+					)
+
+	def test_decay(self):
+		rnd = random.Random(16)
+		for _ in range(100):
+			rows = random_rows(rnd, rnd.randint(1, 200))
+			ranks = sorted(rnd.sample(range(-100, 3000, 100), rnd.randint(0, 8)))
+			args = (rows, ranks, rnd.choice((10, 30, 100)), rnd.choice((0, 10)), 300, rnd.randint(0, 1000))
+
+			expected = engine._decay_python(*args)
+			for p, new_rating in zip(rows, expected[0]):
+				self.assertLessEqual(new_rating, p['rating'])
+			if engine.numpy is not None:
+				self.assertEqual(engine._decay_numpy(*args), expected, args[1:])
+			self.assertEqual(engine.decay(*args), expected)
+
+
+if __name__ == '__main__':
+	unittest.main()
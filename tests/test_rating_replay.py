@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Replay shortcuts against the per-match rating path on random histories.
+Run from the bot directory (config.cfg is required): python -m unittest discover tests
+"""
+import random
+import unittest
+
+from bot.stats.rating import BaseRating, FlatRating, TrueSkillRating, replay_matches, _replay_reference
+
+COLUMNS = ('rating', 'deviation', 'wins', 'losses', 'draws', 'streak')
+
+
+class SkillRating(BaseRating):
+	""" Deterministic rating with changes depending on both teams, deviation and draws """
+
+	def changes(self, winners, losers, draw=False):
+		avg_w = sum(p['rating'] for p in winners) / len(winners)
+		avg_l = sum(p['rating'] for p in losers) / len(losers)
+		k = 0.5 if draw else 1
+		return [
+			[((avg_l - avg_w) / 37 * k + 12, -p['deviation'] / 13) for p in winners],
+			[((avg_w - avg_l) / 41 * k - 12, -p['deviation'] / 17) for p in losers]
+		]
+
+
+def random_params(rnd):
+	return dict(
+		channel_id=1, scale=rnd.choice([50, 100, 133]), win_scale=rnd.choice([100, 105, 150]),
+		loss_scale=rnd.choice([95, 100, 300]), draw_bonus=rnd.choice([0, 10, 33]),
+		ws_boost=rnd.random() < 0.5, ls_boost=rnd.random() < 0.5, min_deviation=rnd.choice([None, 50])
+	)
+
+
+def random_player(rnd, user_id):
+	return dict(
+		user_id=user_id, rating=rnd.randint(0, 3000), deviation=rnd.randint(50, 300),
+		wins=rnd.randint(0, 50), losses=rnd.randint(0, 50), draws=rnd.randint(0, 5),
+		streak=rnd.randint(-7, 7), last_ranked_match_at=None
+	)
+
+
+def random_history(rnd, user_ids, count, team_size):
+	""" Ranked matches as read by BaseRating.rebuild(): draws, score based and legacy winner-only results """
+	matches = []
+	for match_id in range(1, count+1):
+		players = rnd.sample(user_ids, team_size*2)
+		kind = rnd.choice(('draw', 'scores', 'winner'))
+		winner = None if kind == 'draw' else rnd.choice((0, 1))
+		scores = (None, None)
+		if kind == 'scores':
+			scores = (rnd.randint(0, 6), rnd.randint(0, 6))
+		matches.append(dict(
+			match_id=match_id, at=match_id*60, queue_name="queue", winner=winner,
+			alpha_score=scores[0], beta_score=scores[1], teams=(players[:team_size], players[team_size:])
+		))
+	return matches
+
+
+class TestRateSeries(unittest.TestCase):
+
+	def test_flat_rate_series(self):
+		rnd = random.Random(13)
+		for _ in range(500):
+			rating = FlatRating(**random_params(rnd))
+			team_a = [random_player(rnd, i) for i in range(rnd.randint(1, 3))]
+			team_b = [random_player(rnd, i) for i in range(10, 10+rnd.randint(1, 3))]
+			for p in rnd.sample(team_a + team_b, 2):
+				p['rating'] = rnd.randint(0, 40)  # near the rating floor
+			wins_a, wins_b = rnd.randint(0, 30), rnd.randint(0, 30)
+
+			self.assertEqual(
+				rating.rate_series(team_a, team_b, wins_a, wins_b),
+				BaseRating.rate_series(rating, team_a, team_b, wins_a, wins_b),
+				(rating.params, wins_a, wins_b)
+			)
+
+
+class TestReplayMatches(unittest.TestCase):
+
+	def check_replay(self, rating_cls, seed, runs, team_size=2):
+		rnd = random.Random(seed)
+		for _ in range(runs):
+			params = random_params(rnd)
+			user_ids = list(range(rnd.randint(team_size*2, 30)))
+			players = {user_id: random_player(rnd, user_id) for user_id in user_ids}
+			matches = random_history(rnd, user_ids, rnd.randint(1, 60), team_size)
+
+			reference = _replay_reference(rating_cls(**params), players, matches)
+			replayed, history, mismatches = replay_matches(rating_cls, params, players, matches)
+			for user_id, p in reference.items():
+				self.assertEqual(
+					{k: replayed[user_id][k] for k in COLUMNS}, {k: p[k] for k in COLUMNS}, (rating_cls, params)
+				)
+
+			self.assertEqual(len(history), len(matches) * team_size * 2)
+			for user_id in user_ids:
+				changes = [h for h in history if h['user_id'] == user_id]
+				self.assertEqual(
+					players[user_id]['rating'] + sum(h['rating_change'] for h in changes), replayed[user_id]['rating']
+				)
+				if len(changes):
+					self.assertEqual(replayed[user_id]['last_ranked_match_at'], changes[-1]['at'])
+
+	def test_flat(self):
+		self.check_replay(FlatRating, 1, 200)
+
+	def test_skill(self):
+		self.check_replay(SkillRating, 2, 200)
+		self.check_replay(SkillRating, 3, 50, team_size=1)
+
+	def test_trueskill(self):
+		self.check_replay(TrueSkillRating, 4, 30)
+
+	def test_verify(self):
+		rnd = random.Random(5)
+		params = random_params(rnd)
+		players = {user_id: random_player(rnd, user_id) for user_id in range(10)}
+		matches = random_history(rnd, list(players.keys()), 20, 2)
+		self.assertEqual(replay_matches(SkillRating, params, players, matches, verify=True)[2], [])
+
+
+if __name__ == '__main__':
+	unittest.main()
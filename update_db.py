@@ -40,6 +40,7 @@ db.ensure_table(dict(
 
 
 async def main():
+	await db.ensure_tables()
 	config = None
 	qc_cfgs = await db.select(['*'], 'qc_configs')
 	for qc in qc_cfgs: